@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import struct
+import tempfile
+from argparse import ArgumentParser
+from io import BytesIO
+from itertools import count
+from subprocess import run as run_process, PIPE, DEVNULL
+from time import perf_counter, time
+from typing import Callable, Dict, List, Optional, Any, Sequence
+
+from PIL.Image import Image, frombytes, open as open_image
+
+from lib import ic, mlp
+from lib.common import Screenshots, Stages, SimilarScreenshotCondition, SameScreenshotCondition, References, \
+    StagePlan, UnknownStage, FramePyramid, REFERENCES_DIRECTORY, SCREEN_WIDTH, SCREEN_HEIGHT, get_current_stage, \
+    parse_screencap, TICK_INTERVAL
+
+GAMES = {
+    'ic': ic.get_stages_to_test,
+    'mlp': mlp.get_stages_to_test,
+}
+
+
+def create_random_frame(width: int = SCREEN_WIDTH, height: int = SCREEN_HEIGHT) -> Image:
+    return frombytes('RGB', (width, height), os.urandom(width * height * 3))
+
+
+def create_screencap(image: Image) -> bytes:
+    rgba = image.convert('RGBA')
+    return struct.pack('<III', rgba.width, rgba.height, 1) + rgba.tobytes()
+
+
+class KeyRecorder(dict):
+
+    def __init__(self, image: Image):
+        super().__init__()
+        self._image = image
+
+    def __missing__(self, key: str) -> Image:
+        self[key] = self._image
+        return self._image
+
+
+def get_reference_keys(games: Sequence[str]) -> List[str]:
+    references = KeyRecorder(create_random_frame(1, 1))
+    for game in games:
+        for stage in GAMES[game](references):
+            stage.get_condition()
+    return sorted(references)
+
+
+def create_synthetic_references(directory: str, games: Sequence[str]):
+    source = os.path.join(directory, '.reference.png')
+    create_random_frame().save(source, compress_level=1)
+    for key in get_reference_keys(games):
+        path = os.path.join(directory, '%s.png' % key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(source, path)
+    os.remove(source)
+
+
+def measure(function: Callable[[Any], Any], repeat: int, setup: Callable[[], Any] = lambda: None) -> Dict[str, float]:
+    durations = []
+    for _ in range(repeat):
+        argument = setup()
+        now = perf_counter()
+        function(argument)
+        durations.append(perf_counter() - now)
+    return {
+        'repeat': repeat,
+        'mean': statistics.mean(durations),
+        'median': statistics.median(durations),
+        'min': min(durations),
+        'max': max(durations),
+        'stdev': statistics.stdev(durations) if repeat > 1 else 0.0,
+    }
+
+
+def load_references(directory: str, games: Sequence[str]) -> Dict[str, StagePlan]:
+    references = References(directory, games)
+    plans = {game: GAMES[game](references) for game in games}
+    for plan in plans.values():
+        for condition in plan.region_conditions:
+            condition.reference_crop.load()
+    return plans
+
+
+def bench_startup(results: Dict[str, Any], directory: str, games: Sequence[str], repeat: int):
+    results['create_references'] = measure(lambda _: References(directory, games), repeat)
+    results['load_references'] = measure(lambda _: load_references(directory, games), repeat)
+
+
+def bench_decode(results: Dict[str, Any], repeat: int):
+    frame = create_random_frame()
+    raw = create_screencap(frame)
+    buffer = BytesIO()
+    frame.save(buffer, 'png', compress_level=1)
+    png = buffer.getvalue()
+    results['decode_raw'] = measure(lambda _: parse_screencap(raw), repeat)
+    results['decode_png'] = measure(lambda _: open_image(BytesIO(png)).convert('RGB'), repeat)
+
+
+def bench_conditions(results: Dict[str, Any], repeat: int):
+    reference = create_random_frame()
+    frame = create_random_frame()
+    stages = Stages()
+    boxes = {
+        'small': (2432, 1193, 82, 82),
+        'large': (1000, 400, 662, 808),
+        'full': (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT),
+    }
+    for name, box in boxes.items():
+        condition = SimilarScreenshotCondition(reference, *box)
+        condition.reference_crop.load()
+        for outcome, screenshot in (('met', reference), ('not_met', frame)):
+            screenshots = Screenshots()
+            screenshots.add(None, screenshot)
+            results['similar_%s_%s' % (name, outcome)] = measure(
+                lambda _: condition.is_met(screenshots, stages), repeat)
+        near_miss = reference.copy()
+        left, top, width, height = box
+        near_miss.paste(create_random_frame(16, 16), (left + width // 6, top + height // 6))
+        results['similar_%s_near_miss' % name] = measure(lambda _: condition.matches(near_miss), repeat)
+        for factor in condition.pyramid_factors:
+            condition.get_reference_level(factor)
+        pyramid = FramePyramid(near_miss)
+        pyramid.get_level(max(condition.pyramid_factors, default=1))
+        results['similar_%s_near_miss_pyramid' % name] = measure(lambda _: condition.matches(near_miss, pyramid),
+                                                                 repeat)
+    condition = SameScreenshotCondition()
+    for outcome, screenshot in (('met', reference), ('not_met', frame)):
+        screenshots = Screenshots(clock=count(step=TICK_INTERVAL).__next__)
+        screenshots.add(None, reference)
+        screenshots.add(None, screenshot)
+        results['same_%s' % outcome] = measure(lambda _: condition.is_met(screenshots, stages), repeat)
+    results['frame_pyramid'] = measure(lambda _: FramePyramid(frame).get_level(16), repeat)
+    results['screenshots_add'] = measure(lambda _: Screenshots().add(None, frame), repeat)
+
+
+def bench_get_current_stage(results: Dict[str, Any], plans: Dict[str, StagePlan], repeat: int):
+    def setup():
+        screenshots = Screenshots()
+        screenshots.add(None, create_random_frame())
+        return screenshots
+
+    def classify(stages_to_test):
+        def function(screenshots: Screenshots):
+            stage = get_current_stage(stages_to_test, screenshots, Stages())
+            assert type(stage) is UnknownStage, 'worst-case frame classified as %s' % stage
+        return function
+
+    for game, plan in plans.items():
+        results['get_current_stage_%s' % game] = measure(classify(plan), repeat, setup)
+        results['get_current_stage_%s_legacy' % game] = measure(classify(list(plan)), repeat, setup)
+
+
+def bench_screenshots_memory(results: Dict[str, Any], count: int):
+    base = create_random_frame()
+    configurations = {
+        'default': {},
+        'tail_fingerprint': {'tail_count': count, 'tail_format': 'fingerprint'},
+        'tail_compressed': {'tail_count': count, 'tail_format': 'compressed'},
+    }
+    for name, kwargs in configurations.items():
+        screenshots = Screenshots(**kwargs)
+        usage = []
+        for number in range(count):
+            frame = base.copy()
+            frame.paste(create_random_frame(SCREEN_WIDTH, 16), (0, (number * 16) % SCREEN_HEIGHT))
+            screenshots.add(None, frame)
+            usage.append(screenshots.memory_usage)
+        results['screenshots_memory_%s' % name] = {
+            'count': count,
+            'bytes': usage,
+            'final': usage[-1],
+            'per_frame': (usage[-1] - usage[0]) / max(count - 1, 1),
+        }
+
+
+def get_revision() -> Optional[str]:
+    try:
+        result = run_process(['git', 'rev-parse', 'HEAD'], stdout=PIPE, stderr=DEVNULL, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run_benchmarks(games: Sequence[str] = tuple(GAMES), references_directory: Optional[str] = None,
+                   repeat: int = 10, memory_frames: int = 20) -> dict:
+    temporary = None
+    if references_directory is None:
+        temporary = tempfile.mkdtemp(prefix='bench_references_')
+        create_synthetic_references(temporary, games)
+        references_directory = temporary
+    try:
+        results: Dict[str, Any] = {}
+        bench_startup(results, references_directory, games, repeat)
+        bench_decode(results, repeat)
+        bench_conditions(results, repeat)
+        bench_get_current_stage(results, load_references(references_directory, games), repeat)
+        bench_screenshots_memory(results, memory_frames)
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+    return {
+        'meta': {
+            'time': time(),
+            'revision': get_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'references': 'synthetic' if temporary else references_directory,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline: dict, current: dict) -> List[str]:
+    lines = []
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        if 'median' in result:
+            lines.append('%-40s %10.6f -> %10.6f s  x%.2f' % (name, previous['median'], result['median'],
+                                                            result['median'] / previous['median']))
+        elif 'final' in result:
+            lines.append('%-40s %10d -> %10d B  x%.2f' % (name, previous['final'], result['final'],
+                                                        result['final'] / max(previous['final'], 1)))
+    return lines
+
+
+def parse_args():
+    parser = ArgumentParser(description='benchmark the per-tick pipeline')
+    parser.add_argument('--games', nargs='+', choices=tuple(GAMES), default=list(GAMES))
+    parser.add_argument('--references', help='references directory, synthetic references are used by default; '
+                                             'use "%s" for the real ones' % REFERENCES_DIRECTORY)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--memory-frames', type=int, default=20)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', help='previous results to compare with')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.getLogger('lib').setLevel(logging.WARNING)
+    report = run_benchmarks(args.games, args.references, args.repeat, args.memory_frames)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print('\n'.join(compare(json.load(baseline_file), report)))
+    else:
+        for benchmark, value in report['results'].items():
+            if 'median' in value:
+                print('%-40s %10.6f s' % (benchmark, value['median']))
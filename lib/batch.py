@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import sys
+import tarfile
+from io import BytesIO
+from multiprocessing import Pool
+from time import perf_counter
+from typing import Callable, Dict, Iterator, Optional, Tuple, TextIO
+
+from PIL.Image import Image, open as open_image
+
+from lib.common import Screenshots, StagePlan, Stages, create_references, get_current_stage, \
+    get_fingerprint_regions, parse_screencap
+
+logger = logging.getLogger(__name__)
+
+FRAME_EXTENSIONS = ('.png', '.raw')
+
+Frame = Tuple[str, Optional[bytes]]
+
+_stages_to_test: Optional[StagePlan] = None
+
+
+def iterate_frames(source: str) -> Iterator[Frame]:
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file in sorted(files):
+                if file.endswith(FRAME_EXTENSIONS):
+                    yield os.path.join(root, file), None
+        return
+    with tarfile.open(source) as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith(FRAME_EXTENSIONS):
+                yield member.name, archive.extractfile(member).read()
+
+
+def decode_frame(name: str, data: Optional[bytes]) -> Optional[Image]:
+    if data is None:
+        with open(name, 'rb') as file:
+            data = file.read()
+    if name.endswith('.raw'):
+        return parse_screencap(data)
+    return open_image(BytesIO(data)).convert('RGB')
+
+
+def init_worker(stage_list_factory: Callable[[Dict[str, Image]], StagePlan],
+                references_factory: Callable[[], Dict[str, Image]]):
+    global _stages_to_test
+    _stages_to_test = stage_list_factory(references_factory())
+
+
+def classify_frame(frame: Frame) -> dict:
+    name, data = frame
+    now = perf_counter()
+    screenshot = decode_frame(name, data)
+    if screenshot is None:
+        return {'frame': name, 'stage': None, 'time': perf_counter() - now, 'error': 'cannot decode'}
+    screenshots = Screenshots(1, regions=get_fingerprint_regions(_stages_to_test))
+    screenshots.add(None, screenshot)
+    stage = get_current_stage(_stages_to_test, screenshots, Stages())
+    return {'frame': name, 'stage': str(stage), 'time': perf_counter() - now}
+
+
+def classify_frames(source: str, stage_list_factory: Callable[[Dict[str, Image]], StagePlan],
+                    references_factory: Callable[[], Dict[str, Image]] = create_references,
+                    workers: Optional[int] = None, chunk_size: int = 16, output: TextIO = sys.stdout) -> int:
+    frames = iterate_frames(source)
+    if workers == 0:
+        init_worker(stage_list_factory, references_factory)
+        results = map(classify_frame, frames)
+        count = _write_results(results, output, chunk_size)
+    else:
+        with Pool(workers, init_worker, (stage_list_factory, references_factory)) as pool:
+            count = _write_results(pool.imap(classify_frame, frames, chunk_size), output, chunk_size)
+    logger.info('Classified %s frames from %s', count, source)
+    return count
+
+
+def _write_results(results: Iterator[dict], output: TextIO, chunk_size: int) -> int:
+    count = 0
+    for count, result in enumerate(results, 1):
+        output.write('%s\n' % json.dumps(result))
+        if count % chunk_size == 0:
+            output.flush()
+    output.flush()
+    return count
@@ -1,14 +1,36 @@
+import gzip
+import hashlib
+import heapq
+import json
 import logging.config
+import mmap
 import os
+import re
+import shlex
+import signal
+import struct
+import zlib
+from collections import OrderedDict, deque
 from datetime import timedelta
-from subprocess import call
-from tempfile import TemporaryDirectory
+from subprocess import call, run as run_process, PIPE, DEVNULL, Popen
+from threading import Lock, Event, Thread
 from time import time, sleep
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Sequence, Hashable, Iterator, Set, NamedTuple, Deque, \
+    Callable, Any, Mapping
 from uuid import uuid4
 
 from PIL import ImageChops
-from PIL.Image import Image, open as open_image
+from PIL.Image import Image, open as open_image, frombuffer, frombytes, new as new_image
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logging.config.dictConfig({
     'version': 1,
@@ -39,35 +61,291 @@ logging.config.dictConfig({
 logger = logging.getLogger(__name__)
 
 
-ADB = '/opt/android-sdk/platform-tools/adb'
+ADB = os.environ.get('ADB', '/opt/android-sdk/platform-tools/adb')
+GRAB_SCRIPT = os.environ.get('GRAB_SCRIPT', './grab')
 TICK_INTERVAL = 5
+DEFAULT_DEVICE = 'default'
+SCREENCAP_HEADER_SIZE = 12
+SCREEN_WIDTH = 2560
+SCREEN_HEIGHT = 1600
+MAX_WINDOW_ROWS = 64
+PYRAMID_STEP = 4
+PYRAMID_FACTORS = (4, 16)
+
+
+def set_adb_path(path: str):
+    global ADB
+    ADB = path
+    os.environ['ADB'] = path
+
+
+def get_adb_args(serial: Optional[str] = None) -> List[str]:
+    return [ADB, '-s', serial] if serial else [ADB]
 
 
 def create_image(path: str) -> Image:
     return open_image(path).convert('RGB')
 
 
-def create_references() -> Dict[str, Image]:
-    result = {}
-    for root, dirs, files in os.walk('references'):
-        for file in files:
-            path = os.path.join(root, file)
-            key = str(path.split('/', 1)[1]).rsplit('.', 1)[0]
-            result[key] = create_image(path)
-    return result
+def reduce_image(image: Image, factor: int) -> Image:
+    while factor > 1:
+        image = image.reduce(PYRAMID_STEP)
+        factor //= PYRAMID_STEP
+    return image
+
+
+REFERENCES_DIRECTORY = 'references'
+COMMON_REFERENCES = 'common'
+
+
+def get_source_signature(path: str) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class ReferencePack:
+
+    MAGIC = b'REFPACK1'
+    ALIGNMENT = 64
+
+    def __init__(self, path: str):
+        self._path = path
+        with open(path, 'rb') as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError('%s is not a reference pack' % path)
+        header_size, = struct.unpack_from('<Q', self._data, len(self.MAGIC))
+        header_offset = len(self.MAGIC) + 8
+        header = json.loads(self._data[header_offset:header_offset + header_size])
+        data_offset = self._get_data_offset(header_size)
+        self._sources: Dict[str, List[int]] = header['sources']
+        self._entries: Dict[Tuple[str, Tuple[int, int, int, int], int], Tuple[int, Tuple[int, int]]] = {
+            (entry['key'], tuple(entry['box']), entry.get('level', 1)): (data_offset + entry['offset'],
+                                                                         tuple(entry['size']))
+            for entry in header['entries']
+        }
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> Optional['ReferencePack']:
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except (ValueError, KeyError, struct.error) as e:
+            logger.warning('Cannot load reference pack %s: %s', path, e)
+            return None
+
+    def is_fresh(self, key: str, path: str) -> bool:
+        return self._sources.get(key) == get_source_signature(path)
+
+    def has(self, key: str, box: Tuple[int, int, int, int], level: int = 1) -> bool:
+        return (key, box, level) in self._entries
+
+    def get(self, key: str, box: Tuple[int, int, int, int], level: int = 1) -> Optional[Image]:
+        if (key, box, level) not in self._entries:
+            return None
+        offset, size = self._entries[(key, box, level)]
+        length = size[0] * size[1] * 3
+        return frombuffer('RGB', size, memoryview(self._data)[offset:offset + length], 'raw', 'RGB', 0, 1)
+
+    @classmethod
+    def write(cls, path: str, crops: Dict[Tuple[str, Tuple[int, int, int, int], int], Image],
+              sources: Dict[str, str]):
+        entries, chunks = [], []
+        offset = 0
+        for (key, box, level), image in crops.items():
+            data = image.convert('RGB').tobytes()
+            entries.append({'key': key, 'box': list(box), 'level': level, 'size': list(image.size), 'offset': offset})
+            chunks.append(data + bytes(-len(data) % cls.ALIGNMENT))
+            offset += len(chunks[-1])
+        header = json.dumps({
+            'sources': {key: get_source_signature(source) for key, source in sources.items()},
+            'entries': entries,
+        }).encode()
+        temporary_path = '%s.tmp' % path
+        with open(temporary_path, 'wb') as file:
+            file.write(cls.MAGIC + struct.pack('<Q', len(header)) + header)
+            file.write(bytes(cls._get_data_offset(len(header)) - file.tell()))
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temporary_path, path)
+        logger.info('Wrote %s reference crops to %s', len(entries), path)
+
+    @classmethod
+    def _get_data_offset(cls, header_size: int) -> int:
+        offset = len(cls.MAGIC) + 8 + header_size
+        return offset + -offset % cls.ALIGNMENT
+
+
+class LazyReference:
+
+    def __init__(self, key: str, path: str, pack: Optional[ReferencePack] = None):
+        self.key = key
+        self.path = path
+        self._pack = pack if pack is not None and pack.is_fresh(key, path) else None
+        self._image: Optional[Image] = None
+
+    def __repr__(self):
+        return 'LazyReference(%r)' % self.key
+
+    def load(self) -> Image:
+        if self._image is None:
+            logger.debug('Loading reference %s', self.key)
+            self._image = create_image(self.path)
+        return self._image
+
+    def crop(self, box: Tuple[int, int, int, int]) -> Image:
+        if self._pack is not None and self._pack.has(self.key, box):
+            return self._pack.get(self.key, box)
+        return self.load().crop(box)
+
+    def crop_level(self, box: Tuple[int, int, int, int], factor: int) -> Image:
+        if self._pack is not None and self._pack.has(self.key, box, factor):
+            return self._pack.get(self.key, box, factor)
+        return reduce_image(self.crop(box), factor)
+
+
+class References(Mapping):
+
+    def __init__(self, directory: str = REFERENCES_DIRECTORY, games: Optional[Sequence[str]] = None,
+                 pack_path: Optional[str] = None):
+        self._pack = ReferencePack.load(pack_path)
+        self._paths: Dict[str, str] = {}
+        self._references: Dict[str, LazyReference] = {}
+        scopes = None if games is None else set(games) | {COMMON_REFERENCES}
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                path = os.path.join(root, file)
+                key = os.path.relpath(path, directory).replace(os.sep, '/').rsplit('.', 1)[0]
+                if scopes is None or key.split('/', 1)[0] in scopes:
+                    self._paths[key] = path
+
+    def __getitem__(self, key: str) -> LazyReference:
+        if key not in self._references:
+            self._references[key] = LazyReference(key, self._paths[key], self._pack)
+        return self._references[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._paths)
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def get_path(self, key: str) -> str:
+        return self._paths[key]
+
+
+def create_references(games: Optional[Sequence[str]] = None, pack_path: Optional[str] = None) -> References:
+    return References(REFERENCES_DIRECTORY, games, pack_path)
+
+
+def update_reference_pack(path: str, stages_to_test: 'StagePlan') -> bool:
+    pack = ReferencePack.load(path)
+    crops, sources = {}, {}
+    for condition in stages_to_test.region_conditions:
+        reference = condition.reference
+        if not isinstance(reference, LazyReference):
+            continue
+        crops[(reference.key, condition.area, 1)] = condition.reference_crop
+        for factor in condition.pyramid_factors:
+            crops[(reference.key, condition.get_level_box(factor), factor)] = condition.get_reference_level(factor)
+        sources[reference.key] = reference.path
+    if pack is not None and all(pack.has(key, box, level) and pack.is_fresh(key, sources[key])
+                                for key, box, level in crops):
+        return False
+    ReferencePack.write(path, crops, sources)
+    return True
+
+
+def get_sample_positions(start: int, end: int, count: int) -> List[int]:
+    count = min(count, end - start)
+    return sorted({start + (end - start - 1) * i // max(count - 1, 1) for i in range(count)})
+
+
+def count_mismatches(diff: Image, max_delta: int) -> int:
+    mask = diff.point(lambda value: 255 if value > max_delta else 0)
+    combined, *bands = mask.split()
+    for band in bands:
+        combined = ImageChops.lighter(combined, band)
+    return mask.width * mask.height - combined.histogram()[0]
+
+
+Region = Tuple[int, int, int, int]
 
 
 class Condition:
 
+    def __str__(self):
+        return '%s()' % self.__class__.__name__
+
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
         raise NotImplementedError()
 
+    def get_regions(self) -> List[Region]:
+        return []
+
+    def get_key(self) -> Optional[Hashable]:
+        return None
+
+    def get_requirements(self) -> List['SimilarScreenshotCondition']:
+        return []
+
+    def is_frame_only(self) -> bool:
+        return False
+
+    def compile(self, plan: 'StagePlan') -> 'Condition':
+        if self.get_key() is None:
+            return self
+        return plan.get_shared_condition(self)
+
+    def wrap(self, wrapper: Callable[['Condition'], 'Condition']) -> 'Condition':
+        return wrapper(self)
+
+
+def get_frame_key(screenshots: 'Screenshots', history: bool = False) -> Optional[Tuple[bytes, Optional[bytes]]]:
+    last = screenshots.last_fingerprint
+    if last is None:
+        return None
+    previous = screenshots.previous_fingerprint if history else None
+    return last.digest, previous and previous.digest
+
+
+class MemoizedCondition(Condition):
+
+    def __init__(self, condition: Condition):
+        self._condition = condition
+        self._history = not condition.is_frame_only()
+        self._key: Optional[Tuple[bytes, Optional[bytes]]] = None
+        self._result = False
+
+    def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
+        key = get_frame_key(screenshots, self._history)
+        if key is None or key != self._key:
+            self._result = self._condition.is_met(screenshots, stages)
+            self._key = key
+        return self._result
+
+    def get_regions(self) -> List[Region]:
+        return self._condition.get_regions()
+
+    def get_key(self) -> Optional[Hashable]:
+        return self._condition.get_key()
+
+    def get_requirements(self) -> List['SimilarScreenshotCondition']:
+        return self._condition.get_requirements()
+
+    def is_frame_only(self) -> bool:
+        return self._condition.is_frame_only()
+
 
 class TrueCondition(Condition):
 
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
         return True
 
+    def is_frame_only(self) -> bool:
+        return True
+
 
 class NotCondition(Condition):
 
@@ -77,6 +355,18 @@ class NotCondition(Condition):
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
         return not self._condition.is_met(screenshots, stages)
 
+    def get_regions(self) -> List[Region]:
+        return self._condition.get_regions()
+
+    def is_frame_only(self) -> bool:
+        return self._condition.is_frame_only()
+
+    def compile(self, plan: 'StagePlan') -> Condition:
+        return NotCondition(self._condition.compile(plan))
+
+    def wrap(self, wrapper: Callable[[Condition], Condition]) -> Condition:
+        return NotCondition(self._condition.wrap(wrapper))
+
 
 class AndCondition(Condition):
 
@@ -86,6 +376,21 @@ class AndCondition(Condition):
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
         return all(condition.is_met(screenshots, stages) for condition in self._conditions)
 
+    def get_regions(self) -> List[Region]:
+        return [region for condition in self._conditions for region in condition.get_regions()]
+
+    def get_requirements(self) -> List['SimilarScreenshotCondition']:
+        return [requirement for condition in self._conditions for requirement in condition.get_requirements()]
+
+    def is_frame_only(self) -> bool:
+        return all(condition.is_frame_only() for condition in self._conditions)
+
+    def compile(self, plan: 'StagePlan') -> Condition:
+        return AndCondition(*(condition.compile(plan) for condition in self._conditions))
+
+    def wrap(self, wrapper: Callable[[Condition], Condition]) -> Condition:
+        return AndCondition(*(condition.wrap(wrapper) for condition in self._conditions))
+
 
 class OrCondition(Condition):
 
@@ -95,29 +400,167 @@ class OrCondition(Condition):
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
         return any(condition.is_met(screenshots, stages) for condition in self._conditions)
 
+    def get_regions(self) -> List[Region]:
+        return [region for condition in self._conditions for region in condition.get_regions()]
+
+    def is_frame_only(self) -> bool:
+        return all(condition.is_frame_only() for condition in self._conditions)
+
+    def compile(self, plan: 'StagePlan') -> Condition:
+        return OrCondition(*(condition.compile(plan) for condition in self._conditions))
+
+    def wrap(self, wrapper: Callable[[Condition], Condition]) -> Condition:
+        return OrCondition(*(condition.wrap(wrapper) for condition in self._conditions))
+
 
 class SimilarScreenshotCondition(Condition):
 
-    def __init__(self, reference: Image, left: int, top: int, width: int, height: int):
+    SAMPLES_PER_SIDE = 4
+    MIN_SAMPLED_AREA = 64 * 64
+    MIN_PYRAMID_AREA = 256 * 256
+
+    def __init__(self, reference: Image, left: int, top: int, width: int, height: int, max_delta: int = 0,
+                 max_mismatch: float = 0.0):
         self._reference = reference
         self._left = left
         self._top = top
         self._width = width
         self._height = height
+        self._max_delta = max_delta
+        self._max_mismatch = max_mismatch
+        self._reference_crop: Optional[Image] = None
+        self._samples: Optional[List[Tuple[Tuple[int, int], tuple]]] = None
+        self._reference_levels: Dict[int, Image] = {}
+
+    def __str__(self):
+        reference = getattr(self._reference, 'key', None) or 'image@%x' % id(self._reference)
+        tolerance = '' if self.is_exact else ', max_delta=%s, max_mismatch=%s' % (self._max_delta, self._max_mismatch)
+        return 'SimilarScreenshotCondition(%s, %s, %s, %s, %s%s)' % (reference, self._left, self._top, self._width,
+                                                                     self._height, tolerance)
+
+    @property
+    def reference(self) -> Image:
+        return self._reference
+
+    @property
+    def area(self) -> Tuple[int, int, int, int]:
+        return self._left, self._top, self._left + self._width, self._top + self._height
+
+    @property
+    def max_delta(self) -> int:
+        return self._max_delta
+
+    @property
+    def allowed_mismatches(self) -> int:
+        return int(self._max_mismatch * self._width * self._height)
+
+    @property
+    def is_exact(self) -> bool:
+        return not self._max_delta and not self.allowed_mismatches
+
+    @property
+    def reference_crop(self) -> Image:
+        if self._reference_crop is None:
+            self._reference_crop = self._reference.crop(self.area)
+        return self._reference_crop
+
+    @property
+    def samples(self) -> List[Tuple[Tuple[int, int], tuple]]:
+        if self._samples is None:
+            self._samples = []
+            if self._width * self._height >= self.MIN_SAMPLED_AREA:
+                left, top, right, bottom = self.area
+                reference = self.reference_crop
+                self._samples = [((x, y), reference.getpixel((x - left, y - top)))
+                                 for y in get_sample_positions(top, bottom, self.SAMPLES_PER_SIDE)
+                                 for x in get_sample_positions(left, right, self.SAMPLES_PER_SIDE)]
+        return self._samples
+
+    @property
+    def pyramid_factors(self) -> List[int]:
+        if not self.is_exact or self._width * self._height < self.MIN_PYRAMID_AREA:
+            return []
+        return [factor for factor in reversed(PYRAMID_FACTORS) if self.get_level_box(factor) is not None]
+
+    def get_level_box(self, factor: int) -> Optional[Tuple[int, int, int, int]]:
+        left, top, right, bottom = self.area
+        box = (-(-left // factor) * factor, -(-top // factor) * factor,
+               right // factor * factor, bottom // factor * factor)
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        return box
+
+    def get_reference_level(self, factor: int) -> Image:
+        if factor not in self._reference_levels:
+            box = self.get_level_box(factor)
+            if isinstance(self._reference, LazyReference):
+                self._reference_levels[factor] = self._reference.crop_level(box, factor)
+            else:
+                self._reference_levels[factor] = reduce_image(self._reference.crop(box), factor)
+        return self._reference_levels[factor]
 
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
-        area = (self._left, self._top, self._left + self._width, self._top + self._height)
-        diff = ImageChops.difference(screenshots.last.crop(area), self._reference.crop(area))
-        return not diff.getbbox()
+        return self.matches(screenshots.last)
+
+    def matches(self, screenshot: Image, pyramid: Optional['FramePyramid'] = None) -> bool:
+        if not self.matches_samples(screenshot):
+            return False
+        if pyramid is not None and not self.matches_levels(pyramid):
+            return False
+        return self.matches_region(screenshot)
+
+    def matches_levels(self, pyramid: 'FramePyramid') -> bool:
+        left, top, right, bottom = self.area
+        if right > pyramid.screenshot.width or bottom > pyramid.screenshot.height:
+            return True
+        for factor in self.pyramid_factors:
+            left, top, right, bottom = self.get_level_box(factor)
+            level = pyramid.get_level(factor).crop((left // factor, top // factor, right // factor, bottom // factor))
+            if level.tobytes() != self.get_reference_level(factor).tobytes():
+                return False
+        return True
+
+    def matches_region(self, screenshot: Image) -> bool:
+        diff = ImageChops.difference(screenshot.crop(self.area), self.reference_crop)
+        if self.is_exact:
+            return not diff.getbbox()
+        return count_mismatches(diff, self._max_delta) <= self.allowed_mismatches
+
+    def matches_samples(self, screenshot: Image) -> bool:
+        width, height = screenshot.size
+        allowed = self.allowed_mismatches
+        for (x, y), expected in self.samples:
+            actual = screenshot.getpixel((x, y)) if x < width and y < height else (0,) * len(expected)
+            if any(abs(value - reference) > self._max_delta for value, reference in zip(actual, expected)):
+                if not allowed:
+                    return False
+                allowed -= 1
+        return True
+
+    def get_regions(self) -> List[Region]:
+        return [(self._left, self._top, self._width, self._height)]
+
+    def get_key(self) -> Optional[Hashable]:
+        return 'similar', id(self._reference), self.area, self._max_delta, self.allowed_mismatches
+
+    def get_requirements(self) -> List['SimilarScreenshotCondition']:
+        return [self]
+
+    def is_frame_only(self) -> bool:
+        return True
+
+    def compile(self, plan: 'StagePlan') -> Condition:
+        return plan.get_region_condition(self)
 
 
 class SameScreenshotCondition(Condition):
 
+    MIN_DURATION = TICK_INTERVAL
+
     def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
         if not screenshots.previous:
             return False
-        diff = ImageChops.difference(screenshots.last, screenshots.previous)
-        return not diff.getbbox()
+        return screenshots.unchanged_for >= self.MIN_DURATION
 
 
 class IsUnknownForLongTimeCondition(Condition):
@@ -126,15 +569,241 @@ class IsUnknownForLongTimeCondition(Condition):
         return stages.is_unknown_for_long_time
 
 
+class AdbShell:
+
+    MARKER = '__shell_done__'
+    FAILED_STATUS = -1
+
+    def __init__(self, args: Optional[Sequence[str]] = None, tapper: Optional['SendeventTapper'] = None):
+        self._args = get_adb_args() + ['shell'] if args is None else list(args)
+        self._process: Optional[Popen] = None
+        self._lock = Lock()
+        self.tapper = tapper
+
+    def _get_process(self) -> Popen:
+        if self._process is None or self._process.poll() is not None:
+            logger.debug('Starting shell session %s', ' '.join(self._args))
+            self._process = Popen(self._args, stdin=PIPE, stdout=PIPE, stderr=DEVNULL, text=True, bufsize=1)
+        return self._process
+
+    @classmethod
+    def for_device(cls, serial: Optional[str] = None) -> 'AdbShell':
+        return cls(get_adb_args(serial) + ['shell'])
+
+    @classmethod
+    def format_command(cls, args: Sequence) -> Tuple[str, str, str]:
+        return cls.format_line(' '.join(shlex.quote(str(arg)) for arg in args))
+
+    @classmethod
+    def format_line(cls, line: str) -> Tuple[str, str, str]:
+        marker = '%s%s' % (cls.MARKER, uuid4().hex)
+        return line, '%s </dev/null; echo "%s $?"\n' % (line, marker), marker
+
+    @staticmethod
+    def parse_status(line: str, output: str, marker: str) -> Optional[int]:
+        if marker not in output:
+            logger.debug('Shell output: %s', output.rstrip())
+            return None
+        status = int(output.rsplit(marker, 1)[1])
+        if status:
+            logger.warning('Command "%s" failed with status %s', line, status)
+        return status
+
+    def run(self, *args: str) -> int:
+        status, _ = self._execute(self.format_command(args))
+        return status
+
+    def run_line(self, line: str) -> int:
+        status, _ = self._execute(self.format_line(line))
+        return status
+
+    def check_output(self, *args: str) -> Optional[str]:
+        status, output = self._execute(self.format_command(args))
+        return ''.join(output) if status == 0 else None
+
+    def tap(self, x: int, y: int) -> int:
+        if self.tapper is not None:
+            status = self.tapper.tap(self, x, y)
+            if status == 0:
+                return status
+            logger.warning('Cannot inject tap with sendevent, status %s, falling back to input tap', status)
+            self.tapper = None
+        return self.run('input', 'tap', x, y)
+
+    def _execute(self, formatted: Tuple[str, str, str]) -> Tuple[int, List[str]]:
+        line, command, marker = formatted
+        result = []
+        with self._lock:
+            process = self._get_process()
+            try:
+                process.stdin.write(command)
+                process.stdin.flush()
+                for output in process.stdout:
+                    status = self.parse_status(line, output, marker)
+                    if status is not None:
+                        result.append(output.rsplit(marker, 1)[0])
+                        return status, result
+                    result.append(output)
+            except (OSError, ValueError) as e:
+                logger.warning('Shell session broken: %s', e)
+            logger.warning('Shell session closed while running "%s"', line)
+            self._close()
+            return self.FAILED_STATUS, result
+
+    def _close(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class TouchScreen(NamedTuple):
+    path: str
+    x_range: Tuple[int, int]
+    y_range: Tuple[int, int]
+    multi_touch: bool
+    has_slots: bool
+    has_button: bool
+
+
+def parse_touchscreen(output: str) -> Optional[TouchScreen]:
+    for block in output.split('add device ')[1:]:
+        path = block.split('\n', 1)[0].split(': ', 1)[-1].strip()
+        axes = {}
+        for name, minimum, maximum in re.findall(r'(ABS_\w+)\s*: value -?\d+, min (-?\d+), max (-?\d+)', block):
+            axes[name] = int(minimum), int(maximum)
+        multi_touch = 'ABS_MT_POSITION_X' in axes and 'ABS_MT_POSITION_Y' in axes
+        if not multi_touch and ('ABS_X' not in axes or 'ABS_Y' not in axes or 'BTN_TOUCH' not in block):
+            continue
+        prefix = 'ABS_MT_POSITION_' if multi_touch else 'ABS_'
+        return TouchScreen(path, axes[prefix + 'X'], axes[prefix + 'Y'], multi_touch, 'ABS_MT_SLOT' in axes,
+                           'BTN_TOUCH' in block)
+    return None
+
+
+class SendeventTapper:
+
+    EV_SYN, EV_KEY, EV_ABS = 0, 1, 3
+    SYN_REPORT = 0
+    BTN_TOUCH = 0x14a
+    ABS_X, ABS_Y = 0, 1
+    ABS_MT_SLOT, ABS_MT_POSITION_X, ABS_MT_POSITION_Y, ABS_MT_TRACKING_ID = 0x2f, 0x35, 0x36, 0x39
+    EVENT_FORMATS = {32: '<llHHi', 64: '<qqHHi'}
+    TRACKING_ID = 1
+
+    def __init__(self, touchscreen: TouchScreen, display_size: Tuple[int, int], rotation: int = 0,
+                 word_size: int = 64):
+        self._touchscreen = touchscreen
+        self._display_size = display_size
+        self._rotation = rotation
+        self._format = self.EVENT_FORMATS[word_size]
+        self._streams: Dict[Tuple[int, int], str] = {}
+
+    @classmethod
+    def discover(cls, shell: AdbShell) -> Optional['SendeventTapper']:
+        touchscreen = parse_touchscreen(shell.check_output('getevent', '-pl') or '')
+        size = re.search(r'Physical size: (\d+)x(\d+)', shell.check_output('wm', 'size') or '')
+        if touchscreen is None or size is None:
+            logger.warning('Cannot find touchscreen, using input tap')
+            return None
+        rotation = re.search(r'SurfaceOrientation: (\d)', shell.check_output('dumpsys', 'input') or '')
+        abi = shell.check_output('getprop', 'ro.product.cpu.abi') or ''
+        tapper = cls(touchscreen, (int(size.group(1)), int(size.group(2))), int(rotation.group(1)) if rotation else 0,
+                     64 if '64' in abi else 32)
+        logger.info('Injecting taps into %s', touchscreen.path)
+        return tapper
+
+    def to_touch(self, x: int, y: int) -> Tuple[int, int]:
+        width, height = self._display_size
+        if self._rotation == 1:
+            x, y = width - 1 - y, x
+        elif self._rotation == 2:
+            x, y = width - 1 - x, height - 1 - y
+        elif self._rotation == 3:
+            x, y = y, height - 1 - x
+        (x_min, x_max), (y_min, y_max) = self._touchscreen.x_range, self._touchscreen.y_range
+        return (min(x_min + x * (x_max - x_min + 1) // width, x_max),
+                min(y_min + y * (y_max - y_min + 1) // height, y_max))
+
+    def get_events(self, x: int, y: int) -> bytes:
+        touchscreen = self._touchscreen
+        touch_x, touch_y = self.to_touch(x, y)
+        down, up = [], []
+        if touchscreen.multi_touch:
+            if touchscreen.has_slots:
+                down.append((self.EV_ABS, self.ABS_MT_SLOT, 0))
+            down += [(self.EV_ABS, self.ABS_MT_TRACKING_ID, self.TRACKING_ID),
+                     (self.EV_ABS, self.ABS_MT_POSITION_X, touch_x),
+                     (self.EV_ABS, self.ABS_MT_POSITION_Y, touch_y)]
+            up.append((self.EV_ABS, self.ABS_MT_TRACKING_ID, -1))
+        else:
+            down += [(self.EV_ABS, self.ABS_X, touch_x), (self.EV_ABS, self.ABS_Y, touch_y)]
+        if touchscreen.has_button:
+            down.append((self.EV_KEY, self.BTN_TOUCH, 1))
+            up.append((self.EV_KEY, self.BTN_TOUCH, 0))
+        events = down + [(self.EV_SYN, self.SYN_REPORT, 0)] + up + [(self.EV_SYN, self.SYN_REPORT, 0)]
+        return b''.join(struct.pack(self._format, 0, 0, *event) for event in events)
+
+    def get_stream(self, x: int, y: int) -> str:
+        if (x, y) not in self._streams:
+            self._streams[(x, y)] = ''.join('\\%03o' % byte for byte in self.get_events(x, y))
+        return self._streams[(x, y)]
+
+    def tap(self, shell: AdbShell, x: int, y: int) -> int:
+        return shell.run_line('printf %s > %s' % (shlex.quote(self.get_stream(x, y)),
+                                                  shlex.quote(self._touchscreen.path)))
+
+
+class RecordingShell(AdbShell):
+
+    def __init__(self):
+        super().__init__(())
+        self.calls: List[Tuple] = []
+
+    def run(self, *args: str) -> int:
+        self.calls.append(args)
+        return 0
+
+    def close(self):
+        pass
+
+
+_default_shell: Optional[AdbShell] = None
+
+
+def get_shell(shell: Optional[AdbShell] = None) -> AdbShell:
+    global _default_shell
+    if shell:
+        return shell
+    if _default_shell is None:
+        _default_shell = AdbShell()
+    return _default_shell
+
+
 class Command:
 
-    def execute(self):
+    def __str__(self):
+        return '%s()' % self.__class__.__name__
+
+    def execute(self, shell: Optional[AdbShell] = None):
         raise NotImplementedError()
 
+    def flatten(self) -> List['Command']:
+        return [self]
+
+    def expects_change(self) -> bool:
+        return False
+
 
 class NoOpCommand(Command):
 
-    def execute(self):
+    def execute(self, shell: Optional[AdbShell] = None):
         logger.debug('Doing nothing')
 
 
@@ -143,9 +812,18 @@ class BatchCommand(Command):
     def __init__(self, *commands: Command):
         self._commands = commands
 
-    def execute(self):
+    def __str__(self):
+        return 'BatchCommand(%s)' % ', '.join(str(command) for command in self._commands)
+
+    def execute(self, shell: Optional[AdbShell] = None):
         for command in self._commands:
-            command.execute()
+            command.execute(shell)
+
+    def expects_change(self) -> bool:
+        return any(command.expects_change() for command in self._commands)
+
+    def flatten(self) -> List[Command]:
+        return [step for command in self._commands for step in command.flatten()]
 
 
 class StartGameCommand(Command):
@@ -154,9 +832,15 @@ class StartGameCommand(Command):
         self._package_name = package_name
         self._activity_name = activity_name
 
-    def execute(self):
+    def __str__(self):
+        return 'StartGameCommand(%s/%s)' % (self._package_name, self._activity_name)
+
+    def execute(self, shell: Optional[AdbShell] = None):
         logger.debug('Starting game')
-        call([ADB, 'shell', 'am', 'start', '-n', '%s/%s' % (self._package_name, self._activity_name)])
+        get_shell(shell).run('am', 'start', '-n', '%s/%s' % (self._package_name, self._activity_name))
+
+    def expects_change(self) -> bool:
+        return True
 
 
 class StopGameCommand(Command):
@@ -164,9 +848,12 @@ class StopGameCommand(Command):
     def __init__(self, package_name: str):
         self._package_name = package_name
 
-    def execute(self):
+    def __str__(self):
+        return 'StopGameCommand(%s)' % self._package_name
+
+    def execute(self, shell: Optional[AdbShell] = None):
         logger.debug('Stopping game')
-        call([ADB, 'shell', 'am', 'force-stop', self._package_name])
+        get_shell(shell).run('am', 'force-stop', self._package_name)
 
 
 class ClickCommand(Command):
@@ -175,16 +862,22 @@ class ClickCommand(Command):
         self._x = x
         self._y = y
 
-    def execute(self):
+    def __str__(self):
+        return 'ClickCommand(%s, %s)' % (self._x, self._y)
+
+    def execute(self, shell: Optional[AdbShell] = None):
         logger.debug('Clicking to (%s, %s)', self._x, self._y)
-        call([ADB, 'shell', 'input', 'tap', str(self._x), str(self._y)])
+        get_shell(shell).tap(self._x, self._y)
+
+    def expects_change(self) -> bool:
+        return True
 
 
 class TogglePowerCommand(Command):
 
-    def execute(self):
+    def execute(self, shell: Optional[AdbShell] = None):
         logger.debug('Toggling device power')
-        call([ADB, 'shell', 'input', 'keyevent', '26'])
+        get_shell(shell).run('input', 'keyevent', 26)
 
 
 class WaitCommand(Command):
@@ -192,13 +885,24 @@ class WaitCommand(Command):
     def __init__(self, duration: timedelta):
         self._duration = duration
 
-    def execute(self):
+    def __str__(self):
+        return 'WaitCommand(%s)' % self._duration
+
+    @property
+    def duration(self) -> timedelta:
+        return self._duration
+
+    def execute(self, shell: Optional[AdbShell] = None):
         logger.debug('Waiting for %s', self._duration)
         sleep(self._duration.total_seconds())
 
 
 class Stage:
 
+    MIN_INTERVAL = 1.0
+    MAX_INTERVAL = 15.0
+    FAST_POLLING = True
+
     def __init__(self, references: Dict[str, Image]):
         self._references = references
 
@@ -261,11 +965,15 @@ class DesktopStage(Stage):
 
 
 class AbstractAdStage(Stage):
-    pass
+
+    MAX_INTERVAL = 5.0
 
 
 class UnknownAdStage(AbstractAdStage):
 
+    MIN_INTERVAL = TICK_INTERVAL
+    FAST_POLLING = False
+
     def __init__(self, resources: Dict[str, Image], start_game_command: StartGameCommand):
         super().__init__(resources)
         self._start_game_command = start_game_command
@@ -291,6 +999,9 @@ class AnimatedAdStage(AbstractAdStage):
 
 class UnityAdStage(AbstractAdStage):
 
+    MIN_INTERVAL = TICK_INTERVAL
+    FAST_POLLING = False
+
     def __init__(self, resources: Dict[str, Image], start_game_command: StartGameCommand):
         super().__init__(resources)
         self._start_game_command = start_game_command
@@ -308,100 +1019,1065 @@ class UnityAdStage(AbstractAdStage):
         return self._start_game_command
 
 
+def parse_screencap(data: bytes) -> Optional[Image]:
+    if len(data) < SCREENCAP_HEADER_SIZE:
+        return None
+    width, height, _ = struct.unpack_from('<III', data)
+    pixels = memoryview(data)[SCREENCAP_HEADER_SIZE:SCREENCAP_HEADER_SIZE + width * height * 4]
+    if len(pixels) != width * height * 4:
+        return None
+    return frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1).convert('RGB')
+
+
+class Grabber:
+
+    timings: Dict[str, float] = {}
+
+    def fetch(self) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    def decode(self, data: bytes) -> Optional[Image]:
+        raise NotImplementedError()
+
+    def grab(self) -> Optional[Image]:
+        now = time()
+        logger.debug('Grabbing screenshot')
+        self.timings = {}
+        data = self.fetch()
+        fetched = time()
+        self.timings['capture'] = fetched - now
+        if data is None:
+            return None
+        screenshot = self.decode(data)
+        self.timings['decode'] = time() - fetched
+        if screenshot is None:
+            logger.warning('Cannot decode screenshot of %s bytes', len(data))
+            return None
+        logger.debug('Screenshot ready in %.3f seconds', time() - now)
+        return screenshot
+
+
+class ScreencapGrabber(Grabber):
+
+    def __init__(self, serial: Optional[str] = None):
+        self._args = get_adb_args(serial) + ['exec-out', 'screencap']
+
+    def fetch(self) -> Optional[bytes]:
+        result = run_process(self._args, stdout=PIPE, stderr=DEVNULL)
+        if result.returncode:
+            logger.warning('Cannot grab screenshot, adb exited with %s', result.returncode)
+            return None
+        return result.stdout
+
+    def decode(self, data: bytes) -> Optional[Image]:
+        return parse_screencap(data)
+
+
+class RegionGrabber(Grabber):
+
+    COMPRESSIONS = ('none', 'gzip', 'lz4')
+
+    def __init__(self, rows: List[Tuple[int, int]], compression: str = 'none', level: int = 1,
+                 width: int = SCREEN_WIDTH, height: int = SCREEN_HEIGHT, args: Optional[Sequence[str]] = None,
+                 remote_path: str = '/data/local/tmp/screencap.raw',
+                 windows: Optional[List[Tuple[int, int, int, int]]] = None):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError('unknown compression %s' % compression)
+        if compression == 'lz4' and lz4 is None:
+            raise ValueError('lz4 compression requires lz4 package')
+        self._windows = [(0, top, width, bottom) for top, bottom in rows] if windows is None else list(windows)
+        self._compression = compression
+        self._level = level
+        self._width = width
+        self._height = height
+        self._args = get_adb_args() + ['exec-out'] if args is None else list(args)
+        self._remote_path = remote_path
+
+    @classmethod
+    def for_stages(cls, stages_to_test: List['Stage'], **kwargs) -> 'RegionGrabber':
+        width, height = kwargs.get('width', SCREEN_WIDTH), kwargs.get('height', SCREEN_HEIGHT)
+        windows = get_required_windows(stages_to_test, width)
+        area = sum((right - left) * (bottom - top) for left, top, right, bottom in windows)
+        logger.info('Capturing %.1f%% of the screen in %s windows', 100 * area / width / height, len(windows))
+        return cls([], windows=windows, **kwargs)
+
+    def get_remote_command(self) -> str:
+        row_size = self._width * 4
+        commands = [
+            'screencap > %s' % self._remote_path,
+            'dd if=%s bs=%s count=1 2>/dev/null' % (self._remote_path, SCREENCAP_HEADER_SIZE),
+        ]
+        for left, top, right, bottom in self._windows:
+            if right - left == self._width:
+                commands.append('dd if=%s bs=%s skip=%s count=%s iflag=skip_bytes 2>/dev/null' % (
+                    self._remote_path, row_size, SCREENCAP_HEADER_SIZE + top * row_size, bottom - top))
+                continue
+            for row in range(top, bottom):
+                commands.append('dd if=%s bs=%s skip=%s count=1 iflag=skip_bytes 2>/dev/null' % (
+                    self._remote_path, (right - left) * 4, SCREENCAP_HEADER_SIZE + row * row_size + left * 4))
+        command = '{ %s; }' % ' && '.join(commands)
+        if self._compression == 'gzip':
+            command += ' | gzip -%s' % self._level
+        elif self._compression == 'lz4':
+            command += ' | lz4 -%s -c' % self._level
+        return command
+
+    def fetch(self) -> Optional[bytes]:
+        result = run_process(self._args + [self.get_remote_command()], stdout=PIPE, stderr=DEVNULL)
+        if result.returncode:
+            logger.warning('Cannot grab screenshot regions, adb exited with %s', result.returncode)
+            return None
+        if self._compression == 'gzip':
+            return gzip.decompress(result.stdout)
+        if self._compression == 'lz4':
+            return lz4.frame.decompress(result.stdout)
+        return result.stdout
+
+    def decode(self, data: bytes) -> Optional[Image]:
+        expected_size = SCREENCAP_HEADER_SIZE + sum((right - left) * (bottom - top) * 4
+                                                    for left, top, right, bottom in self._windows)
+        if len(data) != expected_size:
+            return None
+        width, height, _ = struct.unpack_from('<III', data)
+        if (width, height) != (self._width, self._height):
+            logger.warning('Unexpected screen size %sx%s', width, height)
+            return None
+        screenshot = new_image('RGB', (width, height))
+        offset = SCREENCAP_HEADER_SIZE
+        for left, top, right, bottom in self._windows:
+            size = (right - left) * (bottom - top) * 4
+            strip = frombuffer('RGBA', (right - left, bottom - top), data[offset:offset + size], 'raw', 'RGBA', 0, 1)
+            screenshot.paste(strip.convert('RGB'), (left, top))
+            offset += size
+        return screenshot
+
+
+class ScreenRecordMonitor:
+
+    RESTART_DELAY = 1.0
+    CHUNK_SIZE = 65536
+
+    def __init__(self, width: int = SCREEN_WIDTH // 4, height: int = SCREEN_HEIGHT // 4, bit_rate: int = 1000000,
+                 args: Optional[Sequence[str]] = None, restart: bool = True):
+        self._args = (get_adb_args() + ['exec-out'] if args is None else list(args)) + [
+            'screenrecord', '--output-format=h264', '--size', '%sx%s' % (width, height),
+            '--bit-rate', str(bit_rate), '-']
+        self._restart = restart
+        self._lock = Lock()
+        self._closed = Event()
+        self._process: Optional[Popen] = None
+        self._streaming = False
+        self._changes = 0
+        self._thread = Thread(target=self._read, name='screenrecord', daemon=True)
+        self._thread.start()
+
+    @property
+    def changes(self) -> Optional[int]:
+        with self._lock:
+            return self._changes if self._streaming else None
+
+    def _start_process(self) -> Optional[Popen]:
+        with self._lock:
+            if self._closed.is_set():
+                return None
+            logger.debug('Starting screen recording %s', ' '.join(self._args))
+            self._process = Popen(self._args, stdout=PIPE, stderr=DEVNULL, start_new_session=True)
+            return self._process
+
+    def _read(self):
+        while True:
+            process = self._start_process()
+            if process is None:
+                return
+            streamed = False
+            try:
+                for _ in iter(lambda: process.stdout.read1(self.CHUNK_SIZE), b''):
+                    with self._lock:
+                        self._changes += 1
+                        self._streaming = streamed = True
+            except (OSError, ValueError) as error:
+                logger.warning('Screen recording broken: %s', error)
+            finally:
+                with self._lock:
+                    self._streaming = False
+                process.stdout.close()
+                process.wait()
+            if not self._restart or self._closed.is_set():
+                return
+            if streamed:
+                logger.debug('Screen recording ended, restarting')
+            else:
+                logger.warning('Screen recording exited with %s without output, retrying', process.returncode)
+                self._closed.wait(self.RESTART_DELAY)
+
+    def close(self):
+        with self._lock:
+            self._closed.set()
+            if self._process is not None and self._process.poll() is None:
+                os.killpg(self._process.pid, signal.SIGTERM)
+        self._thread.join()
+
+
+class StreamGrabber(Grabber):
+
+    def __init__(self, grabber: Optional[Grabber] = None, monitor: Optional[ScreenRecordMonitor] = None,
+                 max_age: float = 6.0):
+        self._grabber = grabber or ScreencapGrabber()
+        self._monitor = monitor or ScreenRecordMonitor()
+        self._max_age = max_age
+        self._screenshot: Optional[Image] = None
+        self._changes: Optional[int] = None
+        self._captured = 0.0
+
+    def grab(self) -> Optional[Image]:
+        changes = self._monitor.changes
+        now = time()
+        if (self._screenshot is not None and changes is not None and changes == self._changes
+                and now - self._captured < self._max_age):
+            logger.debug('Screen unchanged since %.3f seconds, reusing the last capture', now - self._captured)
+            self.timings = {'capture': 0.0, 'decode': 0.0}
+            return self._screenshot.copy()
+        screenshot = self._grabber.grab()
+        self.timings = self._grabber.timings
+        if screenshot is not None:
+            self._screenshot, self._changes, self._captured = screenshot.copy(), changes, now
+        return screenshot
+
+    def close(self):
+        self._monitor.close()
+
+
+class Fingerprint(NamedTuple):
+    digest: bytes
+    regions: Dict[Region, bytes]
+
+
+def get_digest(data: bytes) -> bytes:
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def get_fingerprint(screenshot: Image, regions: Sequence[Region] = ()) -> Fingerprint:
+    region_digests = {}
+    for left, top, width, height in regions:
+        region_digests[(left, top, width, height)] = get_digest(
+            screenshot.crop((left, top, left + width, top + height)).tobytes())
+    return Fingerprint(get_digest(screenshot.tobytes()), region_digests)
+
+
+class TailEntry(NamedTuple):
+    fingerprint: Fingerprint
+    mode: str
+    size: Tuple[int, int]
+    data: Optional[bytes]
+
+
 class Screenshots:
 
-    def __init__(self, max_count: int):
-        self._screenshots: Tuple[str, Image] = []
-        self._max_count = max_count
+    TAIL_FORMATS = ('fingerprint', 'compressed')
+
+    def __init__(self, max_count: int = 2, tail_count: int = 0, tail_format: str = 'fingerprint',
+                 max_tail_bytes: Optional[int] = None, regions: Sequence[Region] = (),
+                 clock: Callable[[], float] = time):
+        if tail_format not in self.TAIL_FORMATS:
+            raise ValueError('unknown tail format %s' % tail_format)
+        self._screenshots: Deque[Tuple[Optional[str], Image, Fingerprint]] = deque(maxlen=max_count)
+        self._tail: Deque[TailEntry] = deque(maxlen=tail_count)
+        self._tail_format = tail_format
+        self._tail_bytes = 0
+        self._max_tail_bytes = max_tail_bytes
+        self._regions = list(regions)
+        self._clock = clock
+        self._added_at = 0.0
+        self._changed_at = 0.0
 
     @property
     def last(self) -> Optional[Image]:
-        return self._get_by_index(0)
+        return self._get_by_index(0, 1)
 
     @property
     def previous(self) -> Optional[Image]:
-        return self._get_by_index(1)
+        return self._get_by_index(1, 1)
+
+    @property
+    def last_fingerprint(self) -> Optional[Fingerprint]:
+        return self._get_by_index(0, 2)
+
+    @property
+    def previous_fingerprint(self) -> Optional[Fingerprint]:
+        return self._get_by_index(1, 2)
+
+    @property
+    def unchanged_for(self) -> float:
+        return self._added_at - self._changed_at
+
+    @property
+    def tail(self) -> List[TailEntry]:
+        return list(self._tail)
+
+    @property
+    def memory_usage(self) -> int:
+        return sum(len(screenshot.getbands()) * screenshot.width * screenshot.height
+                   for _, screenshot, _ in self._screenshots) + self._tail_bytes
 
-    def _get_by_index(self, index: int) -> Optional[Image]:
+    def _get_by_index(self, index: int, field: int):
         try:
-            return self._screenshots[index][1]
+            return self._screenshots[index][field]
         except IndexError:
             return None
 
-    def add(self, path: str, screenshot: Image):
-        self._screenshots.insert(0, (path, screenshot))
-        for path, _ in self._screenshots[self._max_count:]:
+    def add(self, path: Optional[str], screenshot: Image):
+        fingerprint = get_fingerprint(screenshot, self._regions)
+        self._added_at = self._clock()
+        if not self._screenshots or self.last_fingerprint.digest != fingerprint.digest:
+            self._changed_at = self._added_at
+        if len(self._screenshots) == self._screenshots.maxlen:
+            self._evict(*self._screenshots.pop())
+        self._screenshots.appendleft((path, screenshot, fingerprint))
+
+    def _evict(self, path: Optional[str], screenshot: Image, fingerprint: Fingerprint):
+        if path:
             logger.debug('Removing screenshot %s', path)
             os.remove(path)
-        self._screenshots = self._screenshots[:self._max_count]
+        if not self._tail.maxlen:
+            return
+        data = zlib.compress(screenshot.tobytes(), 1) if self._tail_format == 'compressed' else None
+        if len(self._tail) == self._tail.maxlen:
+            self._forget(self._tail.pop())
+        self._tail.appendleft(TailEntry(fingerprint, screenshot.mode, screenshot.size, data))
+        self._tail_bytes += len(data or b'')
+        while self._max_tail_bytes is not None and self._tail_bytes > self._max_tail_bytes:
+            self._forget(self._tail.pop())
+
+    def _forget(self, entry: TailEntry):
+        self._tail_bytes -= len(entry.data or b'')
+
+    def restore(self, entry: TailEntry) -> Optional[Image]:
+        if entry.data is None:
+            return None
+        return frombytes(entry.mode, entry.size, zlib.decompress(entry.data))
+
+
+class StageRun:
+
+    def __init__(self, stage: Stage, started_at: float):
+        self.stage = stage
+        self.count = 1
+        self.started_at = started_at
+        self.last_seen_at = started_at
 
 
 class Stages:
 
-    STAGE_COUNT_TO_BE_UNKNOWN = 20
+    TIME_TO_BE_UNKNOWN = timedelta(seconds=100)
+    DWELL_BUCKETS = (1, 5, 10, 30, 60, 300, 600, 1800, float('inf'))
 
-    def __init__(self, max_count: int):
-        self._stages = []
-        self._max_count = max_count
+    def __init__(self, max_count: int = 100, clock: Callable[[], float] = time):
+        self._runs: Deque[StageRun] = deque(maxlen=max_count)
+        self._clock = clock
+        self._dwell_histograms: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def current(self) -> Optional[Stage]:
+        return self._runs[0].stage if self._runs else None
 
     @property
     def previous(self) -> Optional[Stage]:
-        return self._get_by_index(1)
+        if self._runs and self._runs[0].count > 1:
+            return self._runs[0].stage
+        return self.previous_distinct
+
+    @property
+    def previous_distinct(self) -> Optional[Stage]:
+        return self._runs[1].stage if len(self._runs) > 1 else None
+
+    @property
+    def current_run_length(self) -> int:
+        return self._runs[0].count if self._runs else 0
+
+    @property
+    def time_in_current_stage(self) -> timedelta:
+        if not self._runs:
+            return timedelta()
+        return timedelta(seconds=self._clock() - self._runs[0].started_at)
 
     @property
     def is_unknown_for_long_time(self) -> bool:
-        return all(isinstance(self._get_by_index(i), UnknownStage) for i in range(self.STAGE_COUNT_TO_BE_UNKNOWN))
+        return isinstance(self.current, UnknownStage) and self.time_in_current_stage >= self.TIME_TO_BE_UNKNOWN
 
-    def _get_by_index(self, index: int) -> Optional[Stage]:
-        try:
-            return self._stages[index]
-        except IndexError:
-            return None
+    @property
+    def dwell_histograms(self) -> Dict[str, Dict[str, Any]]:
+        return {name: {'buckets': dict(histogram['buckets']), 'count': histogram['count'], 'sum': histogram['sum']}
+                for name, histogram in self._dwell_histograms.items()}
+
+    def get_run_length(self, stage_class: type) -> int:
+        return self.current_run_length if isinstance(self.current, stage_class) else 0
 
     def add(self, stage: Stage):
-        self._stages.insert(0, stage)
-        self._stages = self._stages[:self._max_count]
+        now = self._clock()
+        if self._runs and self._runs[0].stage is stage:
+            self._runs[0].count += 1
+            self._runs[0].last_seen_at = now
+            return
+        if self._runs:
+            self._record_dwell(self._runs[0], now)
+        self._runs.appendleft(StageRun(stage, now))
+
+    def _record_dwell(self, run: StageRun, now: float):
+        duration = now - run.started_at
+        histogram = self._dwell_histograms.setdefault(str(run.stage), {
+            'buckets': {str(bucket): 0 for bucket in self.DWELL_BUCKETS},
+            'count': 0,
+            'sum': 0.0,
+        })
+        bucket = next(bucket for bucket in self.DWELL_BUCKETS if duration <= bucket)
+        histogram['buckets'][str(bucket)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += duration
 
 
 def grab_screenshot(directory: str) -> Optional[str]:
     now = time()
     logger.debug('Grabbing screenshot')
     path = os.path.join(directory, '%s.png' % uuid4())
-    if call(['./grab', path]):
+    if call([GRAB_SCRIPT, path]):
         logger.warning('Cannot grab screenshot %s', path)
         return None
     logger.debug('Screenshot %s ready in %.3f seconds', path, time() - now)
     return path
 
 
+class FramePyramid:
+
+    def __init__(self, screenshot: Image):
+        self.screenshot = screenshot
+        self._levels: Dict[int, Image] = {1: screenshot}
+
+    def get_level(self, factor: int) -> Image:
+        if factor not in self._levels:
+            self._levels[factor] = self.get_level(factor // PYRAMID_STEP).reduce(PYRAMID_STEP)
+        return self._levels[factor]
+
+
+class RegionMatcher:
+
+    def __init__(self):
+        self._conditions: List[SimilarScreenshotCondition] = []
+        self._key: Optional[bytes] = None
+        self._screenshot: Optional[Image] = None
+        self._results: Dict[int, bool] = {}
+        self._pyramid: Optional[FramePyramid] = None
+
+    def __len__(self) -> int:
+        return len(self._conditions)
+
+    @property
+    def results(self) -> Dict[int, bool]:
+        return dict(self._results)
+
+    def get_region(self, index: int) -> Region:
+        return self._conditions[index].get_regions()[0]
+
+    def get_condition(self, index: int) -> SimilarScreenshotCondition:
+        return self._conditions[index]
+
+    def add(self, condition: SimilarScreenshotCondition) -> int:
+        self._conditions.append(condition)
+        self._key = None
+        return len(self._conditions) - 1
+
+    def update(self, results: Dict[int, bool]):
+        self._results.update(results)
+
+    def prepare(self, screenshot: Image, key: Optional[bytes]):
+        if key is None or key != self._key:
+            self._key = key
+            self._results = {}
+            self._screenshot = screenshot
+            self._pyramid = FramePyramid(screenshot)
+
+    def get_pyramid(self, screenshot: Image) -> 'FramePyramid':
+        if screenshot is not self._screenshot:
+            self._screenshot = screenshot
+            self._pyramid = FramePyramid(screenshot)
+        return self._pyramid
+
+    def is_met(self, index: int, screenshots: 'Screenshots') -> bool:
+        key = screenshots.last_fingerprint and screenshots.last_fingerprint.digest
+        if key is None or key != self._key:
+            self.prepare(screenshots.last, key)
+        if index not in self._results:
+            self._results[index] = self._is_met(index, screenshots.last)
+        return self._results[index]
+
+    def _is_met(self, index: int, screenshot: Image) -> bool:
+        return self._conditions[index].matches(screenshot, self.get_pyramid(screenshot))
+
+
+class RegionCondition(Condition):
+
+    def __init__(self, matcher: RegionMatcher, index: int, condition: SimilarScreenshotCondition):
+        self._matcher = matcher
+        self._index = index
+        self._condition = condition
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    def is_met(self, screenshots: 'Screenshots', stages: 'Stages') -> bool:
+        return self._matcher.is_met(self._index, screenshots)
+
+    def get_regions(self) -> List[Region]:
+        return self._condition.get_regions()
+
+    def get_key(self) -> Optional[Hashable]:
+        return self._condition.get_key()
+
+    def get_requirements(self) -> List[SimilarScreenshotCondition]:
+        return [self._condition]
+
+    def is_frame_only(self) -> bool:
+        return True
+
+
+Pixel = Tuple[int, int]
+PixelIndexNode = Tuple[Pixel, Dict[tuple, 'PixelIndexNode'], 'PixelIndexNode']
+
+
+class PixelIndex:
+
+    SAMPLES_PER_SIDE = 5
+    LEAF_SIZE = 2
+
+    def __init__(self, requirements: List[List[SimilarScreenshotCondition]]):
+        self._constraints = [self._get_constraints(conditions) for conditions in requirements]
+        self._free = frozenset(index for index, constraints in enumerate(self._constraints) if not constraints)
+        self._root = self._build(frozenset(range(len(requirements))) - self._free)
+
+    def _get_constraints(self, conditions: List[SimilarScreenshotCondition]) -> Dict[Pixel, tuple]:
+        result = {}
+        for condition in conditions:
+            if not condition.is_exact:
+                continue
+            left, top, right, bottom = condition.area
+            reference = condition.reference_crop
+            for x in self._get_samples(left, right):
+                for y in self._get_samples(top, bottom):
+                    result[(x, y)] = reference.getpixel((x - left, y - top))
+        return result
+
+    def _get_samples(self, start: int, end: int) -> List[int]:
+        return get_sample_positions(start, end, self.SAMPLES_PER_SIDE)
+
+    def _build(self, candidates: frozenset):
+        if len(candidates) <= self.LEAF_SIZE:
+            return candidates
+        best_pixel, best_size = None, len(candidates)
+        pixels = {pixel for index in candidates for pixel in self._constraints[index]}
+        for pixel in sorted(pixels):
+            groups, unconstrained = self._split(candidates, pixel)
+            size = max(len(group) for group in groups.values()) + len(unconstrained)
+            if size < best_size:
+                best_pixel, best_size = pixel, size
+        if best_pixel is None:
+            return candidates
+        groups, unconstrained = self._split(candidates, best_pixel)
+        children = {value: self._build(frozenset(group | unconstrained)) for value, group in groups.items()}
+        return best_pixel, children, self._build(frozenset(unconstrained))
+
+    def _split(self, candidates: frozenset, pixel: Pixel) -> Tuple[Dict[tuple, set], set]:
+        groups, unconstrained = {}, set()
+        for index in candidates:
+            value = self._constraints[index].get(pixel)
+            if value is None:
+                unconstrained.add(index)
+            else:
+                groups.setdefault(value, set()).add(index)
+        return groups, unconstrained
+
+    def get_candidates(self, screenshot: Image) -> List[int]:
+        node = self._root
+        width, height = screenshot.size
+        while not isinstance(node, frozenset):
+            (x, y), children, default = node
+            value = screenshot.getpixel((x, y)) if x < width and y < height else (0, 0, 0)
+            node = children.get(value, default)
+        return sorted(node | self._free)
+
+
+def are_conflicting(first: SimilarScreenshotCondition, second: SimilarScreenshotCondition) -> bool:
+    first_left, first_top, first_right, first_bottom = first.area
+    second_left, second_top, second_right, second_bottom = second.area
+    left, top = max(first_left, second_left), max(first_top, second_top)
+    right, bottom = min(first_right, second_right), min(first_bottom, second_bottom)
+    if left >= right or top >= bottom:
+        return False
+    first_crop = first.reference_crop.crop((left - first_left, top - first_top, right - first_left,
+                                            bottom - first_top))
+    second_crop = second.reference_crop.crop((left - second_left, top - second_top, right - second_left,
+                                              bottom - second_top))
+    diff = ImageChops.difference(first_crop, second_crop)
+    if first.is_exact and second.is_exact:
+        return diff.getbbox() is not None
+    allowed = first.allowed_mismatches + second.allowed_mismatches
+    return count_mismatches(diff, first.max_delta + second.max_delta) > allowed
+
+
+class StagePlan:
+
+    CACHE_SIZE = 64
+    REGION_CACHE_SIZE = 1024
+    LIKELY_SUCCESSORS = 3
+
+    def __init__(self, stages_to_test: List[Stage]):
+        self._stages = list(stages_to_test)
+        self._matcher = RegionMatcher()
+        self._shared_conditions: Dict[Hashable, Condition] = {}
+        self._conditions: Optional[List[Condition]] = None
+        self._frame_only: List[bool] = []
+        self._index: Optional[PixelIndex] = None
+        self._cache: OrderedDict[bytes, Tuple[Dict[int, bool], Optional[int]]] = OrderedDict()
+        self._region_cache: OrderedDict[Tuple[int, bytes], bool] = OrderedDict()
+        self._positions = {id(stage): index for index, stage in reversed(list(enumerate(self._stages)))}
+        self._requirements: List[List[SimilarScreenshotCondition]] = []
+        self._exclusive: Dict[Tuple[int, int], bool] = {}
+        self._transitions: Dict[Optional[int], Dict[int, int]] = {}
+
+    def __iter__(self) -> Iterator[Stage]:
+        return iter(self._stages)
+
+    def __len__(self) -> int:
+        return len(self._stages)
+
+    def __getitem__(self, index: int) -> Stage:
+        return self._stages[index]
+
+    @property
+    def conditions(self) -> List[Condition]:
+        if self._conditions is None:
+            self._compile()
+        return self._conditions
+
+    @property
+    def index(self) -> PixelIndex:
+        if self._index is None:
+            self._compile()
+        return self._index
+
+    @property
+    def region_conditions(self) -> List[SimilarScreenshotCondition]:
+        if self._conditions is None:
+            self._compile()
+        return [self._matcher.get_condition(index) for index in range(len(self._matcher))]
+
+    @property
+    def regions(self) -> List[Region]:
+        if self._conditions is None:
+            self._compile()
+        return sorted({self._matcher.get_region(index) for index in range(len(self._matcher))})
+
+    def _compile(self):
+        conditions = []
+        for stage in self._stages:
+            conditions.append(stage.get_condition().compile(self))
+        self._requirements = [condition.get_requirements() for condition in conditions]
+        self._index = PixelIndex(self._requirements)
+        self._frame_only = [condition.is_frame_only() for condition in conditions]
+        self._conditions = conditions
+        logger.info('Compiled %s stages into %s unique checks', len(self._stages), len(self._shared_conditions))
+
+    def get_shared_condition(self, condition: Condition) -> Condition:
+        key = condition.get_key()
+        if key not in self._shared_conditions:
+            self._shared_conditions[key] = MemoizedCondition(condition)
+        return self._shared_conditions[key]
+
+    def get_region_condition(self, condition: SimilarScreenshotCondition) -> Condition:
+        key = condition.get_key()
+        if key not in self._shared_conditions:
+            self._shared_conditions[key] = RegionCondition(self._matcher, self._matcher.add(condition), condition)
+        return self._shared_conditions[key]
+
+    def get_candidates(self, screenshot: Image) -> List[int]:
+        return self.index.get_candidates(screenshot)
+
+    @property
+    def transitions(self) -> Dict[Optional[int], Dict[int, int]]:
+        return {previous: dict(counts) for previous, counts in self._transitions.items()}
+
+    def add_transition(self, previous: Optional[int], current: int):
+        counts = self._transitions.setdefault(previous, {})
+        counts[current] = counts.get(current, 0) + 1
+
+    def is_exclusive(self, first: int, second: int) -> bool:
+        key = (min(first, second), max(first, second))
+        if key not in self._exclusive:
+            if self._conditions is None:
+                self._compile()
+            self._exclusive[key] = any(are_conflicting(a, b) for a in self._requirements[first]
+                                       for b in self._requirements[second])
+        return self._exclusive[key]
+
+    def get_current_stage(self, screenshots: 'Screenshots', stages: 'Stages') -> Stage:
+        previous = self._positions.get(id(stages.current))
+        index = self._classify(screenshots, stages, previous)
+        self.add_transition(previous, index)
+        return self._stages[index]
+
+    def _get_order(self, candidates: List[int], previous: Optional[int]) -> List[int]:
+        counts = self._transitions.get(previous)
+        if not counts:
+            return candidates
+        allowed = set(candidates)
+        likely = [index for index in sorted(counts, key=lambda index: (-counts[index], index)) if index in allowed]
+        likely = likely[:self.LIKELY_SUCCESSORS]
+        return likely + [index for index in candidates if index not in likely]
+
+    def _classify(self, screenshots: 'Screenshots', stages: 'Stages', previous: Optional[int]) -> int:
+        conditions = self.conditions
+        fingerprint = screenshots.last_fingerprint
+        results, cached_index = self._get_cached(fingerprint)
+        if cached_index is not None:
+            logger.debug('Frame already classified')
+            return cached_index
+        candidates = self.get_candidates(screenshots.last)
+        key = fingerprint and fingerprint.digest
+        self._matcher.prepare(screenshots.last, key)
+        self._matcher.update(results)
+        failed: Set[int] = set()
+        for index in self._get_order(candidates, previous):
+            if index in failed:
+                continue
+            if not conditions[index].is_met(screenshots, stages):
+                failed.add(index)
+                continue
+            while True:
+                blocker = next((i for i in candidates if i < index and i not in failed
+                                and not self.is_exclusive(i, index)), None)
+                if blocker is None:
+                    break
+                if conditions[blocker].is_met(screenshots, stages):
+                    index = blocker
+                else:
+                    failed.add(blocker)
+            frame_only = self._frame_only[index] and all(self._frame_only[i] for i in failed if i < index)
+            self._store_cached(fingerprint, index if frame_only else None)
+            return index
+        raise RuntimeError('stage not defined')
+
+    def _get_cached(self, fingerprint: Optional[Fingerprint]) -> Tuple[Dict[int, bool], Optional[int]]:
+        if fingerprint is None:
+            return {}, None
+        if fingerprint.digest in self._cache:
+            self._cache.move_to_end(fingerprint.digest)
+            return self._cache[fingerprint.digest]
+        results = {}
+        for index in range(len(self._matcher)):
+            digest = fingerprint.regions.get(self._matcher.get_region(index))
+            if (index, digest) in self._region_cache:
+                results[index] = self._region_cache[(index, digest)]
+        return results, None
+
+    def _store_cached(self, fingerprint: Optional[Fingerprint], index: Optional[int]):
+        if fingerprint is None:
+            return
+        results = self._matcher.results
+        self._cache[fingerprint.digest] = results, index
+        self._cache.move_to_end(fingerprint.digest)
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        for region_index, result in results.items():
+            digest = fingerprint.regions.get(self._matcher.get_region(region_index))
+            if digest is not None:
+                self._region_cache[(region_index, digest)] = result
+                self._region_cache.move_to_end((region_index, digest))
+        while len(self._region_cache) > self.REGION_CACHE_SIZE:
+            self._region_cache.popitem(last=False)
+
+
+def compile_stages(stages_to_test: List[Stage]) -> StagePlan:
+    return StagePlan(stages_to_test)
+
+
 def get_current_stage(stages_to_test: List[Stage], screenshots: Screenshots, stages: Stages) -> Optional[Stage]:
+    if hasattr(stages_to_test, 'get_current_stage'):
+        return stages_to_test.get_current_stage(screenshots, stages)
     for stage in stages_to_test:
         if stage.get_condition().is_met(screenshots, stages):
             return stage
     raise RuntimeError('stage not defined')
 
 
-def handle_tick(stages_to_test: List[Stage], directory: str, screenshots: Screenshots,
-                stages: Stages) -> Tuple[Screenshots, Stages, float]:
-    path = grab_screenshot(directory)
-    if not path:
-        return screenshots, stages, TICK_INTERVAL
-    screenshot = create_image(path)
-    screenshots.add(path, screenshot)
+def get_fingerprint_regions(stages_to_test: List[Stage]) -> List[Region]:
+    return list(getattr(stages_to_test, 'regions', ()))
+
+
+def get_required_windows(stages_to_test: List[Stage], width: int = SCREEN_WIDTH,
+                         max_window_rows: int = MAX_WINDOW_ROWS) -> List[Tuple[int, int, int, int]]:
+    regions = [region for stage in stages_to_test for region in stage.get_condition().get_regions()]
+    result = []
+    for top, bottom in get_required_rows(stages_to_test):
+        if bottom - top > max_window_rows:
+            result.append((0, top, width, bottom))
+            continue
+        columns = [(left, left + region_width) for left, region_top, region_width, region_height in regions
+                   if region_top < bottom and region_top + region_height > top]
+        result.append((min(left for left, _ in columns), top, max(right for _, right in columns), bottom))
+    return result
+
+
+def get_required_rows(stages_to_test: List[Stage]) -> List[Tuple[int, int]]:
+    result = []
+    regions = (region for stage in stages_to_test for region in stage.get_condition().get_regions())
+    for top, bottom in sorted((top, top + height) for _, top, _, height in regions):
+        if result and top <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], bottom))
+        else:
+            result.append((top, bottom))
+    return result
+
+
+class Deadlines:
+
+    def __init__(self, path: Optional[str] = None, clock: Callable[[], float] = time):
+        self._path = path
+        self._clock = clock
+        self._deadlines: Dict[str, float] = {}
+        self._steps: Dict[str, List[Command]] = {}
+        self._heap: List[Tuple[float, str]] = []
+        if path and os.path.exists(path):
+            with open(path) as file:
+                for key, deadline in json.load(file).items():
+                    self._push(key, deadline)
+            logger.info('Loaded %s deadlines from %s', len(self._deadlines), path)
+
+    def _push(self, key: str, deadline: float):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+
+    def _save(self):
+        if not self._path:
+            return
+        path = '%s.tmp' % self._path
+        with open(path, 'w') as file:
+            json.dump(self._deadlines, file)
+        os.replace(path, self._path)
+
+    def schedule(self, key: str, duration: timedelta, steps: Sequence[Command] = ()):
+        deadline = self._clock() + duration.total_seconds()
+        logger.debug('Resuming %s at %s', key, deadline)
+        self._push(key, deadline)
+        self._steps[key] = list(steps)
+        self._save()
+
+    def get_remaining(self, key: str) -> float:
+        if key not in self._deadlines:
+            return 0
+        return max(self._deadlines[key] - self._clock(), 0)
+
+    def get_next(self) -> Optional[Tuple[float, str]]:
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def pop(self, key: str) -> List[Command]:
+        if key not in self._deadlines:
+            return []
+        del self._deadlines[key]
+        self._save()
+        return self._steps.pop(key, [])
+
+
+def execute_command(command: Command, shell: Optional[AdbShell] = None, deadlines: Optional[Deadlines] = None,
+                    key: str = DEFAULT_DEVICE):
+    steps = command.flatten()
+    for position, step in enumerate(steps):
+        if deadlines is not None and isinstance(step, WaitCommand):
+            deadlines.schedule(key, step.duration, steps[position + 1:])
+            return
+        step.execute(shell)
+
+
+class TickScheduler:
+
+    FAST_INTERVAL = 0.3
+    MAX_FAST_POLLS = 20
+    BACKOFF = 2
+
+    def __init__(self):
+        self._interval: Optional[float] = None
+        self._fast_polls: Optional[int] = None
+
+    def get_interval(self, stage: Stage, command: Command, changed: bool) -> float:
+        if stage.FAST_POLLING and command.expects_change():
+            self._fast_polls = 0
+            return self.FAST_INTERVAL
+        if (stage.FAST_POLLING and self._fast_polls is not None and not changed
+                and self._fast_polls < self.MAX_FAST_POLLS):
+            self._fast_polls += 1
+            return self.FAST_INTERVAL
+        self._fast_polls = None
+        if changed or self._interval is None:
+            self._interval = stage.MIN_INTERVAL
+        else:
+            self._interval = self._interval * self.BACKOFF
+        self._interval = max(stage.MIN_INTERVAL, min(self._interval, stage.MAX_INTERVAL))
+        return self._interval
+
+
+class TickRecorder:
+
+    def record(self, screenshots: Screenshots, stage: Stage, command: Command):
+        raise NotImplementedError()
+
+
+class TickMetrics:
+
+    PHASES = ('capture', 'decode', 'classify', 'execute', 'sleep')
+    LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+    def __init__(self, listeners: Sequence[Callable[[dict], None]] = ()):
+        self._listeners = list(listeners)
+        self._lock = Lock()
+        self._histograms: Dict[str, dict] = {}
+        self._stages: Dict[str, int] = {}
+        self._commands: Dict[str, int] = {}
+        self._capture_failures = 0
+        self._ticks = 0
+        self._tick: Optional[dict] = None
+
+    def start_tick(self):
+        self._tick = {'time': time(), 'phases': {}, 'stage': None, 'commands': [], 'captured': True}
+
+    def observe(self, phase: str, duration: float):
+        with self._lock:
+            self._observe(phase, duration)
+        if self._tick is not None:
+            self._tick['phases'][phase] = self._tick['phases'].get(phase, 0) + duration
+
+    def count_capture_failure(self):
+        with self._lock:
+            self._capture_failures += 1
+        if self._tick is not None:
+            self._tick['captured'] = False
+
+    def count_stage(self, stage: Stage):
+        name = stage.__class__.__name__
+        with self._lock:
+            self._stages[name] = self._stages.get(name, 0) + 1
+        if self._tick is not None:
+            self._tick['stage'] = name
+
+    def count_command(self, command: Command):
+        names = [step.__class__.__name__ for step in command.flatten()]
+        with self._lock:
+            for name in names:
+                self._commands[name] = self._commands.get(name, 0) + 1
+        if self._tick is not None:
+            self._tick['commands'].extend(names)
+
+    def finish_tick(self) -> Optional[dict]:
+        tick, self._tick = self._tick, None
+        if tick is None:
+            return None
+        with self._lock:
+            self._ticks += 1
+            self._observe('tick', sum(duration for phase, duration in tick['phases'].items() if phase != 'sleep'))
+        for listener in self._listeners:
+            listener(tick)
+        return tick
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'ticks': self._ticks,
+                'capture_failures': self._capture_failures,
+                'stages': dict(self._stages),
+                'commands': dict(self._commands),
+                'histograms': {phase: dict(histogram, buckets=dict(histogram['buckets']))
+                               for phase, histogram in self._histograms.items()},
+            }
+
+    def _observe(self, phase: str, duration: float):
+        histogram = self._histograms.setdefault(phase, {
+            'buckets': {str(bucket): 0 for bucket in self.LATENCY_BUCKETS},
+            'count': 0,
+            'sum': 0.0,
+        })
+        bucket = next(bucket for bucket in self.LATENCY_BUCKETS if duration <= bucket)
+        histogram['buckets'][str(bucket)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += duration
+
+
+def handle_tick(stages_to_test: List[Stage], grabber: Grabber, screenshots: Screenshots, stages: Stages,
+                shell: Optional[AdbShell] = None, scheduler: Optional[TickScheduler] = None,
+                deadlines: Optional[Deadlines] = None, recorder: Optional[TickRecorder] = None,
+                metrics: Optional[TickMetrics] = None) -> Tuple[Screenshots, Stages, float]:
+    if deadlines is not None and deadlines.get_remaining(DEFAULT_DEVICE) > 0:
+        return screenshots, stages, deadlines.get_remaining(DEFAULT_DEVICE)
+    metrics = metrics or TickMetrics()
+    metrics.start_tick()
+    wait = _handle_tick(stages_to_test, grabber, screenshots, stages, shell, scheduler, deadlines, recorder, metrics)
+    metrics.observe('sleep', wait)
+    metrics.finish_tick()
+    return screenshots, stages, wait
+
+
+def _handle_tick(stages_to_test: List[Stage], grabber: Grabber, screenshots: Screenshots, stages: Stages,
+                 shell: Optional[AdbShell], scheduler: Optional[TickScheduler], deadlines: Optional[Deadlines],
+                 recorder: Optional[TickRecorder], metrics: TickMetrics) -> float:
+    if deadlines is not None:
+        now = time()
+        execute_command(BatchCommand(*deadlines.pop(DEFAULT_DEVICE)), shell, deadlines)
+        metrics.observe('execute', time() - now)
+    now = time()
+    screenshot = grabber.grab()
+    duration = time() - now
+    decode = grabber.timings.get('decode', 0.0)
+    metrics.observe('capture', duration - decode)
+    metrics.observe('decode', decode)
+    if not screenshot:
+        metrics.count_capture_failure()
+        return TICK_INTERVAL
+    screenshots.add(None, screenshot)
+    now = time()
     stage = get_current_stage(stages_to_test, screenshots, stages)
+    metrics.observe('classify', time() - now)
+    metrics.count_stage(stage)
     logger.info('Stage now is %s', stage)
     stages.add(stage)
-    stage.get_command(stages).execute()
-    return screenshots, stages, TICK_INTERVAL
-
+    command = stage.get_command(stages)
+    now = time()
+    execute_command(command, shell, deadlines)
+    metrics.observe('execute', time() - now)
+    metrics.count_command(command)
+    if recorder is not None:
+        recorder.record(screenshots, stage, command)
+    if deadlines is not None and deadlines.get_remaining(DEFAULT_DEVICE) > 0:
+        return deadlines.get_remaining(DEFAULT_DEVICE)
+    if not scheduler:
+        return TICK_INTERVAL
+    previous = screenshots.previous_fingerprint
+    changed = previous is None or previous.digest != screenshots.last_fingerprint.digest
+    return scheduler.get_interval(stage, command, changed)
+
+
+def run(stages_to_test, grabber: Optional[Grabber] = None, shell: Optional[AdbShell] = None,
+        deadlines: Optional[Deadlines] = None, recorder: Optional[TickRecorder] = None,
+        metrics: Optional[TickMetrics] = None):
+    grabber = grabber or ScreencapGrabber()
+    shell = get_shell(shell)
+    scheduler = TickScheduler()
+    deadlines = deadlines or Deadlines()
+    screenshots = Screenshots(regions=get_fingerprint_regions(stages_to_test))
+    stages = Stages()
+    while True:
+        screenshots, stages, wait = handle_tick(stages_to_test, grabber, screenshots, stages, shell, scheduler,
+                                                deadlines, recorder, metrics)
+        if wait > 0:
+            logger.debug('Sleeping for %.3f seconds', wait)
+            sleep(wait)
 
-def run(stages_to_test):
-    with TemporaryDirectory() as directory:
-        logger.info('Using directory %s as storage', directory)
-        screenshots = Screenshots(100)
-        stages = Stages(100)
-        while True:
-            screenshots, stages, wait = handle_tick(stages_to_test, directory, screenshots, stages)
-            if wait > 0:
-                logger.debug('Sleeping for %.3f seconds', wait)
-                sleep(wait)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from time import time
+from typing import List, Optional, Sequence, Callable, Dict, Tuple
+
+from PIL.Image import Image
+
+from lib.common import AdbShell, Command, RecordingShell, Screenshots, StagePlan, Stages, TickScheduler, \
+    WaitCommand, TICK_INTERVAL, get_adb_args, get_current_stage, parse_screencap, Deadlines, BatchCommand, \
+    DEFAULT_DEVICE, get_fingerprint_regions
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAdbShell:
+
+    def __init__(self, args: Sequence[str]):
+        self._args = list(args)
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def for_device(cls, serial: Optional[str] = None) -> 'AsyncAdbShell':
+        return cls(get_adb_args(serial) + ['shell'])
+
+    async def _get_process(self) -> asyncio.subprocess.Process:
+        if self._process is None or self._process.returncode is not None:
+            logger.debug('Starting shell session %s', ' '.join(self._args))
+            self._process = await asyncio.create_subprocess_exec(
+                *self._args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL)
+        return self._process
+
+    async def run(self, *args: str) -> int:
+        line, command, marker = AdbShell.format_command(args)
+        async with self._lock:
+            process = await self._get_process()
+            try:
+                process.stdin.write(command.encode())
+                await process.stdin.drain()
+                while True:
+                    output = await process.stdout.readline()
+                    if not output:
+                        break
+                    status = AdbShell.parse_status(line, output.decode(errors='replace'), marker)
+                    if status is not None:
+                        return status
+            except (OSError, ValueError) as e:
+                logger.warning('Shell session broken: %s', e)
+            logger.warning('Shell session closed while running "%s"', line)
+            await self._close()
+            return AdbShell.FAILED_STATUS
+
+    async def _close(self):
+        if self._process is None:
+            return
+        if self._process.returncode is None:
+            self._process.kill()
+        await self._process.wait()
+        self._process = None
+
+    async def close(self):
+        async with self._lock:
+            await self._close()
+
+
+class AsyncScreencapGrabber:
+
+    def __init__(self, serial: Optional[str] = None):
+        self._args = get_adb_args(serial) + ['exec-out', 'screencap']
+
+    async def grab(self) -> Optional[Image]:
+        now = time()
+        process = await asyncio.create_subprocess_exec(*self._args, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        data, _ = await process.communicate()
+        if process.returncode:
+            logger.warning('Cannot grab screenshot, adb exited with %s', process.returncode)
+            return None
+        screenshot = await asyncio.to_thread(parse_screencap, data)
+        if screenshot is None:
+            logger.warning('Cannot decode screenshot of %s bytes', len(data))
+            return None
+        logger.debug('Screenshot ready in %.3f seconds', time() - now)
+        return screenshot
+
+
+async def execute_command(command: Command, shell: AsyncAdbShell, deadlines: Optional[Deadlines] = None,
+                          key: str = DEFAULT_DEVICE):
+    steps = command.flatten()
+    for position, step in enumerate(steps):
+        if isinstance(step, WaitCommand):
+            if deadlines is not None:
+                deadlines.schedule(key, step.duration, steps[position + 1:])
+                return
+            logger.debug('Waiting for %s', step.duration)
+            await asyncio.sleep(step.duration.total_seconds())
+            continue
+        recorder = RecordingShell()
+        step.execute(recorder)
+        for args in recorder.calls:
+            await shell.run(*args)
+
+
+class DeviceRunner:
+
+    def __init__(self, serial: str, stages_to_test: StagePlan, grabber: Optional[AsyncScreencapGrabber] = None,
+                 shell: Optional[AsyncAdbShell] = None, deadlines: Optional[Deadlines] = None):
+        self._serial = serial
+        self._stages_to_test = stages_to_test
+        self._grabber = grabber or AsyncScreencapGrabber(serial)
+        self._shell = shell or AsyncAdbShell.for_device(serial)
+        self._deadlines = deadlines or Deadlines()
+        self._screenshots = Screenshots(regions=get_fingerprint_regions(stages_to_test))
+        self._stages = Stages()
+        self._scheduler = TickScheduler()
+
+    async def handle_tick(self) -> float:
+        remaining = self._deadlines.get_remaining(self._serial)
+        if remaining > 0:
+            return remaining
+        await execute_command(BatchCommand(*self._deadlines.pop(self._serial)), self._shell, self._deadlines,
+                              self._serial)
+        screenshot = await self._grabber.grab()
+        if not screenshot:
+            return TICK_INTERVAL
+        self._screenshots.add(None, screenshot)
+        stage = await asyncio.to_thread(get_current_stage, self._stages_to_test, self._screenshots, self._stages)
+        logger.info('Stage of %s now is %s', self._serial, stage)
+        self._stages.add(stage)
+        command = stage.get_command(self._stages)
+        await execute_command(command, self._shell, self._deadlines, self._serial)
+        remaining = self._deadlines.get_remaining(self._serial)
+        if remaining > 0:
+            return remaining
+        previous = self._screenshots.previous_fingerprint
+        changed = previous is None or previous.digest != self._screenshots.last_fingerprint.digest
+        return self._scheduler.get_interval(stage, command, changed)
+
+    async def run(self):
+        try:
+            while True:
+                wait = await self.handle_tick()
+                if wait > 0:
+                    logger.debug('Device %s sleeping for %.3f seconds', self._serial, wait)
+                    await asyncio.sleep(wait)
+        finally:
+            await self._shell.close()
+
+
+async def run_devices(devices: List[Tuple[str, str]], references: Dict[str, Image],
+                      stage_list_factories: Dict[str, Callable[[Dict[str, Image]], StagePlan]],
+                      deadlines: Optional[Deadlines] = None):
+    deadlines = deadlines or Deadlines()
+    runners = []
+    for serial, game in devices:
+        if game not in stage_list_factories:
+            raise RuntimeError('unknown game %s' % game)
+        logger.info('Running %s on device %s', game, serial)
+        runners.append(DeviceRunner(serial, stage_list_factories[game](references), deadlines=deadlines))
+    await asyncio.gather(*(runner.run() for runner in runners))
@@ -1,12 +1,12 @@
 from datetime import timedelta
-from typing import Dict, List
+from typing import Dict
 
 from PIL.Image import Image
 
 from lib.common import Stage, Condition, AndCondition, SimilarScreenshotCondition, NotCondition, ClickCommand, \
     Command, BatchCommand, TogglePowerCommand, WaitCommand, StopGameCommand, UnknownAdStage, UnityAdStage, Stages, \
     PowerOffStage, DesktopStage, UnknownStage, StartGameCommand, OrCondition, UnexpectedStateStage, AnimatedAdStage, \
-    AbstractAdStage
+    AbstractAdStage, StagePlan, compile_stages
 
 
 class DailyBonusStage(Stage):
@@ -186,11 +186,11 @@ class AdSkippedStage(Stage):
         return ClickCommand(766, 1422)
 
 
-def get_stages_to_test(references: Dict[str, Image]) -> List[Stage]:
+def get_stages_to_test(references: Dict[str, Image]) -> StagePlan:
     package_name = 'com.playflock.indianacat'
     start_game_command = StartGameCommand(package_name, 'unity.pfplugins.com.activitybridge.UnityActivityOverrider')
     stop_game_command = StopGameCommand(package_name)
-    return [
+    return compile_stages([
         PowerOffStage(references),
         DesktopStage(references, start_game_command),
         DailyBonusStage(references),
@@ -212,4 +212,4 @@ def get_stages_to_test(references: Dict[str, Image]) -> List[Stage]:
         AnimatedAdStage(references),
         UnexpectedStateStage(references, stop_game_command),
         UnknownStage(references)
-    ]
+    ])
@@ -0,0 +1,91 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from threading import Thread
+from typing import Dict, List
+
+from lib.common import TickMetrics
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'bot'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_histogram(name: str, histograms: Dict[str, dict]) -> List[str]:
+    lines = ['# TYPE %s histogram' % name]
+    for phase, histogram in sorted(histograms.items()):
+        label = 'phase="%s"' % escape_label(phase)
+        total = 0
+        for bucket, count in histogram['buckets'].items():
+            total += count
+            lines.append('%s_bucket{%s,le="%s"} %s' % (name, label, '+Inf' if bucket == 'inf' else bucket, total))
+        lines.append('%s_sum{%s} %s' % (name, label, histogram['sum']))
+        lines.append('%s_count{%s} %s' % (name, label, histogram['count']))
+    return lines
+
+
+def format_counter(name: str, label: str, values: Dict[str, int]) -> List[str]:
+    lines = ['# TYPE %s counter' % name]
+    for value, count in sorted(values.items()):
+        lines.append('%s{%s="%s"} %s' % (name, label, escape_label(value), count))
+    return lines
+
+
+def format_prometheus(metrics: TickMetrics) -> str:
+    snapshot = metrics.snapshot()
+    lines = [
+        '# TYPE %s_ticks_total counter' % PREFIX,
+        '%s_ticks_total %s' % (PREFIX, snapshot['ticks']),
+        '# TYPE %s_capture_failures_total counter' % PREFIX,
+        '%s_capture_failures_total %s' % (PREFIX, snapshot['capture_failures']),
+    ]
+    lines += format_counter('%s_stage_ticks_total' % PREFIX, 'stage', snapshot['stages'])
+    lines += format_counter('%s_commands_total' % PREFIX, 'command', snapshot['commands'])
+    lines += format_histogram('%s_phase_seconds' % PREFIX, snapshot['histograms'])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    metrics: TickMetrics
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = format_prometheus(self.metrics).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug('Metrics request: %s', format % args)
+
+
+def serve_metrics(metrics: TickMetrics, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'metrics': metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, server.server_address[1])
+    return server
+
+
+class MetricsFile:
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3):
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def __call__(self, tick: dict):
+        self._handler.emit(logging.makeLogRecord({'msg': json.dumps(tick)}))
+
+    def close(self):
+        self._handler.close()
@@ -1,9 +1,10 @@
-from typing import Dict, List
+from typing import Dict
 
 from PIL.Image import Image
 
 from lib.common import Stage, UnityAdStage, Command, Condition, SimilarScreenshotCondition, Stages, ClickCommand, \
-    UnknownStage, StartGameCommand, AndCondition, OrCondition, SameScreenshotCondition, AbstractAdStage
+    UnknownStage, StartGameCommand, AndCondition, OrCondition, SameScreenshotCondition, AbstractAdStage, StagePlan, \
+    TICK_INTERVAL, compile_stages
 
 
 class NextEpisodeStage(Stage):
@@ -29,6 +30,9 @@ class InteractiveAdStage(AbstractAdStage):
 
 class AnotherAdStage(AbstractAdStage):
 
+    MIN_INTERVAL = TICK_INTERVAL
+    FAST_POLLING = False
+
     def get_condition(self) -> Condition:
         return AndCondition(
             OrCondition(
@@ -42,12 +46,12 @@ class AnotherAdStage(AbstractAdStage):
         return ClickCommand(1500, 90)
 
 
-def get_stages_to_test(references: Dict[str, Image]) -> List[Stage]:
+def get_stages_to_test(references: Dict[str, Image]) -> StagePlan:
     start_game_command = StartGameCommand('com.nevosoft.mylittleplanet', '.Main')
-    return [
+    return compile_stages([
         NextEpisodeStage(references),
         InteractiveAdStage(references),
         AnotherAdStage(references),
         UnityAdStage(references, start_game_command),
         UnknownStage(references)
-    ]
+    ])
@@ -0,0 +1,223 @@
+import logging
+from collections import deque
+from threading import Condition, Thread
+from time import time
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from PIL.Image import Image
+
+from lib.common import AdbShell, BatchCommand, Command, Deadlines, Grabber, NoOpCommand, Screenshots, Stage, Stages, \
+    TickMetrics, TickRecorder, TickScheduler, DEFAULT_DEVICE, TICK_INTERVAL, execute_command, get_current_stage, \
+    get_fingerprint_regions, get_shell
+
+logger = logging.getLogger(__name__)
+
+
+class Frame(NamedTuple):
+    generation: int
+    started: float
+    screenshot: Optional[Image]
+    timings: Dict[str, float]
+
+
+def changes_screen(command: Command) -> bool:
+    return any(not isinstance(step, NoOpCommand) for step in command.flatten())
+
+
+class Pipeline:
+
+    def __init__(self, grabber: Grabber, shell: Optional[AdbShell] = None, deadlines: Optional[Deadlines] = None):
+        self._grabber = grabber
+        self._shell = shell
+        self._deadlines = deadlines
+        self._changed = Condition()
+        self._generation = 0
+        self._frame: Optional[Frame] = None
+        self._commands: Deque[Command] = deque()
+        self._executing = False
+        self._executed = 0.0
+        self._executions: List[float] = []
+        self._captured = 0.0
+        self._interval = 0.0
+        self._closed = False
+        self._capturing = True
+        self.discarded = 0
+        self._threads = [Thread(target=self._capture, name='capture', daemon=True),
+                         Thread(target=self._execute, name='execute', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _is_idle(self) -> bool:
+        return not self._commands and not self._executing
+
+    def _push(self, command: Command):
+        self._generation += 1
+        if self._frame is not None:
+            self.discarded += 1
+            self._frame = None
+        self._commands.append(command)
+        self._changed.notify_all()
+
+    def _wait_for_capture(self) -> Optional[int]:
+        while not self._closed:
+            if self._frame is not None or not self._is_idle():
+                self._changed.wait()
+                continue
+            if self._deadlines is not None:
+                remaining = self._deadlines.get_remaining(DEFAULT_DEVICE)
+                if remaining > 0:
+                    self._changed.wait(remaining)
+                    continue
+                steps = self._deadlines.pop(DEFAULT_DEVICE)
+                if steps:
+                    self._push(BatchCommand(*steps))
+                    continue
+            remaining = max(self._captured, self._executed) + self._interval - time()
+            if remaining > 0:
+                self._changed.wait(remaining)
+                continue
+            self._captured = time()
+            return self._generation
+        return None
+
+    def _capture(self):
+        try:
+            while True:
+                with self._changed:
+                    generation = self._wait_for_capture()
+                if generation is None:
+                    return
+                started = time()
+                try:
+                    screenshot = self._grabber.grab()
+                except Exception:
+                    logger.exception('Cannot grab screenshot')
+                    screenshot = None
+                frame = Frame(generation, started, screenshot, dict(self._grabber.timings))
+                with self._changed:
+                    if generation != self._generation:
+                        logger.debug('Discarding frame captured before command %s', self._generation)
+                        self.discarded += 1
+                    else:
+                        self._frame = frame
+                        self._changed.notify_all()
+        finally:
+            with self._changed:
+                self._capturing = False
+                self._changed.notify_all()
+
+    def _execute(self):
+        while True:
+            with self._changed:
+                while not self._commands and not self._closed:
+                    self._changed.wait()
+                if self._closed:
+                    return
+                command = self._commands.popleft()
+                self._executing = True
+            now = time()
+            try:
+                execute_command(command, self._shell, self._deadlines)
+            except Exception:
+                logger.exception('Cannot execute %s', command)
+            finally:
+                with self._changed:
+                    self._executing = False
+                    self._executed = time()
+                    self._executions.append(self._executed - now)
+                    self._changed.notify_all()
+
+    def get_frame(self) -> Tuple[Frame, List[float]]:
+        with self._changed:
+            while self._frame is None and not self._closed and self._capturing:
+                self._changed.wait()
+            if self._frame is None:
+                raise RuntimeError('pipeline is closed' if self._closed else 'capture thread has stopped')
+            frame, self._frame = self._frame, None
+            executions, self._executions = self._executions, []
+            self._changed.notify_all()
+        return frame, executions
+
+    def submit(self, command: Command, interval: float):
+        with self._changed:
+            self._interval = interval
+            if changes_screen(command):
+                self._push(command)
+            self._changed.notify_all()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+class PipelinedRunner:
+
+    def __init__(self, stages_to_test, grabber: Grabber, shell: Optional[AdbShell] = None,
+                 deadlines: Optional[Deadlines] = None, recorder: Optional[TickRecorder] = None,
+                 metrics: Optional[TickMetrics] = None, scheduler: Optional[TickScheduler] = None):
+        self._stages_to_test = stages_to_test
+        self._pipeline = Pipeline(grabber, shell, deadlines)
+        self._recorder = recorder
+        self._metrics = metrics or TickMetrics()
+        self._scheduler = scheduler
+        self.screenshots = Screenshots(regions=get_fingerprint_regions(stages_to_test))
+        self.stages = Stages()
+
+    @property
+    def pipeline(self) -> Pipeline:
+        return self._pipeline
+
+    def tick(self) -> Optional[Stage]:
+        now = time()
+        frame, executions = self._pipeline.get_frame()
+        metrics = self._metrics
+        metrics.start_tick()
+        metrics.observe('sleep', time() - now)
+        for duration in executions:
+            metrics.observe('execute', duration)
+        metrics.observe('capture', frame.timings.get('capture', 0.0))
+        metrics.observe('decode', frame.timings.get('decode', 0.0))
+        if not frame.screenshot:
+            metrics.count_capture_failure()
+            self._pipeline.submit(NoOpCommand(), TICK_INTERVAL)
+            metrics.finish_tick()
+            return None
+        self.screenshots.add(None, frame.screenshot)
+        now = time()
+        stage = get_current_stage(self._stages_to_test, self.screenshots, self.stages)
+        metrics.observe('classify', time() - now)
+        metrics.count_stage(stage)
+        logger.info('Stage now is %s', stage)
+        self.stages.add(stage)
+        command = stage.get_command(self.stages)
+        self._pipeline.submit(command, self.get_interval(stage, command))
+        metrics.count_command(command)
+        if self._recorder is not None:
+            self._recorder.record(self.screenshots, stage, command)
+        metrics.finish_tick()
+        return stage
+
+    def get_interval(self, stage: Stage, command: Command) -> float:
+        if not self._scheduler:
+            return TICK_INTERVAL
+        previous = self.screenshots.previous_fingerprint
+        changed = previous is None or previous.digest != self.screenshots.last_fingerprint.digest
+        return self._scheduler.get_interval(stage, command, changed)
+
+    def close(self):
+        self._pipeline.close()
+
+
+def run_pipelined(stages_to_test, grabber: Grabber, shell: Optional[AdbShell] = None,
+                  deadlines: Optional[Deadlines] = None, recorder: Optional[TickRecorder] = None,
+                  metrics: Optional[TickMetrics] = None):
+    runner = PipelinedRunner(stages_to_test, grabber, get_shell(shell), deadlines or Deadlines(), recorder, metrics,
+                             TickScheduler())
+    try:
+        while True:
+            runner.tick()
+    finally:
+        runner.close()
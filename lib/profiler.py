@@ -0,0 +1,119 @@
+import atexit
+import logging
+import signal
+import sys
+from threading import RLock
+from time import perf_counter
+from typing import Dict, Hashable, Iterator, List, Optional, TextIO
+
+from lib.common import Condition, Region, Screenshots, SimilarScreenshotCondition, Stage, Stages
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+
+    def __init__(self):
+        self.evaluations = 0
+        self.hits = 0
+        self.time = 0.0
+        self.miss_time = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.evaluations if self.evaluations else 0.0
+
+    def add(self, met: bool, duration: float):
+        self.evaluations += 1
+        self.time += duration
+        if met:
+            self.hits += 1
+        else:
+            self.miss_time += duration
+
+
+class ProfiledCondition(Condition):
+
+    def __init__(self, condition: Condition, counter: Counter):
+        self._condition = condition
+        self._counter = counter
+
+    def __str__(self):
+        return str(self._condition)
+
+    def is_met(self, screenshots: Screenshots, stages: Stages) -> bool:
+        now = perf_counter()
+        result = self._condition.is_met(screenshots, stages)
+        self._counter.add(result, perf_counter() - now)
+        return result
+
+    def get_regions(self) -> List[Region]:
+        return self._condition.get_regions()
+
+    def get_key(self) -> Optional[Hashable]:
+        return self._condition.get_key()
+
+    def get_requirements(self) -> List[SimilarScreenshotCondition]:
+        return self._condition.get_requirements()
+
+    def is_frame_only(self) -> bool:
+        return self._condition.is_frame_only()
+
+
+class ConditionProfiler:
+
+    def __init__(self, stages_to_test: List[Stage]):
+        self._stages = list(stages_to_test)
+        self._lock = RLock()
+        self._frames = 0
+        self._stage_counters = [Counter() for _ in self._stages]
+        self._condition_counters: Dict[str, Counter] = {}
+        self._conditions = [stage.get_condition().wrap(self._wrap) for stage in self._stages]
+
+    def __iter__(self) -> Iterator[Stage]:
+        return iter(self._stages)
+
+    def __len__(self) -> int:
+        return len(self._stages)
+
+    def __getitem__(self, index: int) -> Stage:
+        return self._stages[index]
+
+    def _wrap(self, condition: Condition) -> Condition:
+        return ProfiledCondition(condition, self._condition_counters.setdefault(str(condition), Counter()))
+
+    def get_current_stage(self, screenshots: Screenshots, stages: Stages) -> Stage:
+        with self._lock:
+            self._frames += 1
+            for stage, condition, counter in zip(self._stages, self._conditions, self._stage_counters):
+                now = perf_counter()
+                met = condition.is_met(screenshots, stages)
+                counter.add(met, perf_counter() - now)
+                if met:
+                    return stage
+        raise RuntimeError('stage not defined')
+
+    def get_report(self) -> str:
+        with self._lock:
+            lines = ['Profiled %s frames' % self._frames, '',
+                     '%-32s %8s %8s %12s %12s' % ('stage', 'evals', 'hit %', 'total ms', 'before match ms')]
+            stage_counters = zip(self._stages, self._stage_counters)
+            for stage, counter in sorted(stage_counters, key=lambda item: -item[1].miss_time):
+                lines.append('%-32s %8d %8.1f %12.1f %12.1f' % (stage, counter.evaluations, counter.hit_rate * 100,
+                                                                 counter.time * 1000, counter.miss_time * 1000))
+            lines += ['', '%-64s %8s %8s %12s' % ('condition', 'evals', 'hit %', 'total ms')]
+            for name, counter in sorted(self._condition_counters.items(), key=lambda item: -item[1].time):
+                lines.append('%-64s %8d %8.1f %12.1f' % (name, counter.evaluations, counter.hit_rate * 100,
+                                                         counter.time * 1000))
+        return '\n'.join(lines)
+
+
+def install_report_handlers(profiler: ConditionProfiler, output: TextIO = sys.stderr):
+    def report(*_):
+        output.write('%s\n' % profiler.get_report())
+        output.flush()
+
+    atexit.register(report)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, report)
+        logger.info('Send SIGUSR1 to print the condition profile')
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import zlib
+from time import time
+from typing import Callable, Iterator, List, Optional
+
+from PIL.Image import Image, frombytes
+
+from lib.common import Command, Deadlines, Grabber, RecordingShell, Screenshots, Stage, StagePlan, Stages, \
+    TickRecorder, TickScheduler, get_fingerprint_regions, handle_tick
+
+logger = logging.getLogger(__name__)
+
+TICKS_FILE = 'ticks.jsonl'
+FRAMES_DIRECTORY = 'frames'
+
+
+class SessionRecorder(TickRecorder):
+
+    def __init__(self, directory: str, clock: Callable[[], float] = time):
+        self._directory = directory
+        self._clock = clock
+        os.makedirs(os.path.join(directory, FRAMES_DIRECTORY), exist_ok=True)
+        self._ticks = open(os.path.join(directory, TICKS_FILE), 'a')
+
+    def record(self, screenshots: Screenshots, stage: Stage, command: Command):
+        screenshot = screenshots.last
+        frame = screenshots.last_fingerprint.digest.hex()
+        path = os.path.join(self._directory, FRAMES_DIRECTORY, frame)
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                file.write(zlib.compress(screenshot.tobytes(), 1))
+        self._ticks.write('%s\n' % json.dumps({
+            'time': self._clock(),
+            'frame': frame,
+            'mode': screenshot.mode,
+            'size': list(screenshot.size),
+            'stage': str(stage),
+            'commands': [str(step) for step in command.flatten()],
+        }))
+        self._ticks.flush()
+
+    def close(self):
+        self._ticks.close()
+
+
+class MemoryRecorder(TickRecorder):
+
+    def __init__(self, clock: Callable[[], float] = time):
+        self._clock = clock
+        self.ticks: List[dict] = []
+
+    def record(self, screenshots: Screenshots, stage: Stage, command: Command):
+        self.ticks.append({
+            'time': self._clock(),
+            'frame': screenshots.last_fingerprint.digest.hex(),
+            'stage': str(stage),
+            'commands': [str(step) for step in command.flatten()],
+        })
+
+
+class SessionArchive:
+
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(os.path.join(self._directory, TICKS_FILE)) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def load_frame(self, tick: dict) -> Image:
+        with open(os.path.join(self._directory, FRAMES_DIRECTORY, tick['frame']), 'rb') as file:
+            return frombytes(tick['mode'], tuple(tick['size']), zlib.decompress(file.read()))
+
+
+class VirtualClock:
+
+    def __init__(self, now: float = 0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ReplayGrabber(Grabber):
+
+    def __init__(self):
+        self.screenshot: Optional[Image] = None
+
+    def grab(self) -> Optional[Image]:
+        screenshot, self.screenshot = self.screenshot, None
+        return screenshot
+
+
+def replay_session(directory: str, stages_to_test: StagePlan) -> List[dict]:
+    archive = SessionArchive(directory)
+    clock = VirtualClock()
+    grabber = ReplayGrabber()
+    shell = RecordingShell()
+    recorder = MemoryRecorder(clock)
+    scheduler = TickScheduler()
+    deadlines = Deadlines(clock=clock)
+    screenshots = Screenshots(regions=get_fingerprint_regions(stages_to_test), clock=clock)
+    stages = Stages(clock=clock)
+    frame, screenshot = None, None
+    results = []
+    for tick in archive:
+        clock.now = tick['time']
+        if tick['frame'] != frame:
+            frame, screenshot = tick['frame'], archive.load_frame(tick)
+        grabber.screenshot = screenshot
+        count = len(recorder.ticks)
+        screenshots, stages, _ = handle_tick(stages_to_test, grabber, screenshots, stages, shell, scheduler,
+                                             deadlines, recorder)
+        actual = recorder.ticks[-1] if len(recorder.ticks) > count else None
+        results.append({
+            'time': tick['time'],
+            'frame': tick['frame'],
+            'expected': tick['stage'],
+            'actual': actual and actual['stage'],
+            'expected_commands': tick['commands'],
+            'actual_commands': actual and actual['commands'],
+        })
+    mismatches = sum(1 for result in results if result['expected'] != result['actual'])
+    logger.info('Replayed %s ticks from %s, %s mismatches', len(results), directory, mismatches)
+    return results
+
+
+def learn_transitions(stages_to_test: StagePlan, directory: str) -> int:
+    positions = {str(stage): index for index, stage in reversed(list(enumerate(stages_to_test)))}
+    previous = None
+    count = 0
+    for tick in SessionArchive(directory):
+        index = positions.get(tick['stage'])
+        if index is None:
+            continue
+        stages_to_test.add_transition(previous, index)
+        previous = index
+        count += 1
+    logger.info('Learned %s stage transitions from %s', count, directory)
+    return count
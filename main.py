@@ -1,16 +1,119 @@
 #!/usr/bin/env python3
 
-import sys
+import asyncio
+import json
+from argparse import ArgumentParser
+from functools import partial
 
 from lib import ic, mlp
-from lib.common import run, create_references
+from lib.batch import classify_frames
+from lib.common import run, create_references, RegionGrabber, ScreencapGrabber, StreamGrabber, Deadlines, \
+    update_reference_pack, set_adb_path, TickMetrics, AdbShell, SendeventTapper
+from lib.devices import run_devices
+from lib.metrics import MetricsFile, serve_metrics
+from lib.pipeline import run_pipelined
+from lib.profiler import ConditionProfiler, install_report_handlers
+from lib.session import SessionRecorder, learn_transitions, replay_session
+
+GAMES = {
+    'ic': ic.get_stages_to_test,
+    'mlp': mlp.get_stages_to_test,
+}
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('game', help='ic, mlp, "devices" followed by SERIAL:GAME pairs, '
+                                     '"classify" followed by GAME and a directory or tar of frames '
+                                     'or "replay" followed by GAME and a recorded session directory')
+    parser.add_argument('arguments', nargs='*')
+    parser.add_argument('--capture', choices=('full', 'regions'), default='full')
+    parser.add_argument('--watch-stream', action='store_true',
+                        help='keep screenrecord running and reuse the last capture while its stream shows no change')
+    parser.add_argument('--compression', choices=RegionGrabber.COMPRESSIONS, default='none')
+    parser.add_argument('--compression-level', type=int, default=1)
+    parser.add_argument('--deadlines', default='deadlines.json', help='file to persist pending waits in')
+    parser.add_argument('--workers', type=int, help='worker processes for classify, 0 to run in-process')
+    parser.add_argument('--pack', help='precompiled reference pack, rebuilt when references change')
+    parser.add_argument('--adb', help='adb executable, for example ./fake_adb to run without a device')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this local port')
+    parser.add_argument('--metrics-file', help='rolling JSON lines file with per-tick timings')
+    parser.add_argument('--profile', action='store_true',
+                        help='time every condition in stage order and print a report at exit or on SIGUSR1')
+    parser.add_argument('--learn', action='append', default=[],
+                        help='recorded session to learn stage transitions from, can be repeated')
+    parser.add_argument('--record', help='directory to record the session to')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='capture the next frame and execute commands on worker threads while classifying')
+    parser.add_argument('--tap', choices=('input', 'sendevent'), default='input',
+                        help='inject taps with "input tap" or by writing events to the touchscreen device')
+    return parser.parse_args()
+
+
+def get_stages_to_test(game, pack, profile, sessions=()):
+    stages_to_test = GAMES[game](create_references([game], pack))
+    for session in sessions:
+        learn_transitions(stages_to_test, session)
+    if not profile:
+        return stages_to_test
+    profiler = ConditionProfiler(stages_to_test)
+    install_report_handlers(profiler)
+    return profiler
+
+
+def parse_devices(values):
+    result = []
+    for value in values:
+        serial, _, game = value.rpartition(':')
+        if not serial:
+            raise RuntimeError('device should be SERIAL:GAME, got %s' % value)
+        result.append((serial, game))
+    return result
+
 
 if __name__ == '__main__':
-    references = create_references()
-    if sys.argv[1] == 'ic':
-        stage_list_factory = ic.get_stages_to_test
-    elif sys.argv[1] == 'mlp':
-        stage_list_factory = mlp.get_stages_to_test
+    args = parse_args()
+    if args.adb:
+        set_adb_path(args.adb)
+    if args.game == 'classify':
+        game, source = args.arguments
+        if game not in GAMES:
+            raise RuntimeError('unknown game %s' % game)
+        classify_frames(source, GAMES[game], partial(create_references, [game], args.pack), workers=args.workers)
+        raise SystemExit()
+    if args.game == 'replay':
+        game, directory = args.arguments
+        if game not in GAMES:
+            raise RuntimeError('unknown game %s' % game)
+        for result in replay_session(directory, get_stages_to_test(game, args.pack, args.profile)):
+            print(json.dumps(result))
+        raise SystemExit()
+    deadlines = Deadlines(args.deadlines)
+    if args.game == 'devices':
+        devices = parse_devices(args.arguments)
+        references = create_references([game for _, game in devices], args.pack)
+        asyncio.run(run_devices(devices, references, GAMES, deadlines))
+    elif args.game in GAMES:
+        stages_to_test = get_stages_to_test(args.game, args.pack, args.profile, args.learn)
+        if args.pack and not args.profile:
+            update_reference_pack(args.pack, stages_to_test)
+        if args.capture == 'regions':
+            grabber = RegionGrabber.for_stages(stages_to_test, compression=args.compression,
+                                               level=args.compression_level)
+        else:
+            grabber = ScreencapGrabber()
+        if args.watch_stream:
+            grabber = StreamGrabber(grabber)
+        recorder = SessionRecorder(args.record) if args.record else None
+        metrics = TickMetrics([MetricsFile(args.metrics_file)] if args.metrics_file else [])
+        if args.metrics_port:
+            serve_metrics(metrics, args.metrics_port)
+        shell = AdbShell()
+        if args.tap == 'sendevent':
+            shell.tapper = SendeventTapper.discover(shell)
+        if args.pipeline:
+            run_pipelined(stages_to_test, grabber, shell, deadlines=deadlines, recorder=recorder, metrics=metrics)
+        else:
+            run(stages_to_test, grabber, shell, deadlines=deadlines, recorder=recorder, metrics=metrics)
     else:
-        raise RuntimeError('unknown game %s' % sys.argv[1])
-    run(stage_list_factory(references))
+        raise RuntimeError('unknown game %s' % args.game)
@@ -1,12 +1,37 @@
+import asyncio
+import json
+import os
+import struct
+import tarfile
+from io import StringIO
+from collections import defaultdict
+from datetime import timedelta
+from itertools import count
 from random import randint
+from time import sleep, time
+from typing import List, Optional, Tuple
+from urllib.request import urlopen
 
 import pytest
-from PIL.Image import Image, frombytes
+from PIL.Image import Image, frombytes, new as new_image
 
-from lib import common, ic, mlp
-from lib.common import Screenshots, Stages, UnknownStage, TrueCondition, Condition, create_references, NotCondition, \
-    AndCondition, OrCondition, SimilarScreenshotCondition, SameScreenshotCondition, grab_screenshot, get_current_stage
-from lib.ic import StartStage
+import bench
+from lib import common, ic, mlp, devices
+from lib.batch import classify_frames
+from lib.metrics import MetricsFile, format_prometheus, serve_metrics
+from lib.pipeline import PipelinedRunner
+from lib.profiler import ConditionProfiler
+from lib.session import SessionRecorder, learn_transitions, replay_session
+from lib.common import Screenshots, Stage, Stages, UnknownStage, TrueCondition, Condition, create_references, \
+    NotCondition, AndCondition, OrCondition, SimilarScreenshotCondition, SameScreenshotCondition, grab_screenshot, \
+    get_current_stage, parse_screencap, ScreencapGrabber, AdbShell, ClickCommand, BatchCommand, TogglePowerCommand, \
+    RegionGrabber, get_required_rows, compile_stages, StagePlan, PixelIndex, TickScheduler, NoOpCommand, \
+    WaitCommand, StartGameCommand, Command, Deadlines, execute_command, References, LazyReference, ReferencePack, \
+    update_reference_pack, handle_tick, Grabber, set_adb_path, TickMetrics, FramePyramid, RecordingShell, \
+    SendeventTapper, TouchScreen, parse_touchscreen, StreamGrabber, get_fingerprint_regions, get_required_windows, \
+    ScreenRecordMonitor
+from lib.devices import AsyncAdbShell, DeviceRunner
+from lib.ic import StartStage, StartBonusStage, BankStage, BankTimerStage
 
 
 @pytest.fixture
@@ -36,6 +61,20 @@ def create_random_content_image(path: str) -> Image:
     return image
 
 
+class ConditionStage(UnknownStage):
+
+    def __init__(self, condition: Condition, command: Command = NoOpCommand()):
+        super().__init__(None)
+        self._condition = condition
+        self._command = command
+
+    def get_condition(self) -> Condition:
+        return self._condition
+
+    def get_command(self, stages) -> Command:
+        return self._command
+
+
 @pytest.fixture
 def single_screenshot(image1):
     screenshots = Screenshots(1)
@@ -45,7 +84,7 @@ def single_screenshot(image1):
 
 @pytest.fixture
 def two_screenshots(image1, image2):
-    screenshots = Screenshots(2)
+    screenshots = Screenshots(2, clock=count(step=common.TICK_INTERVAL).__next__)
     screenshots.add('', image1)
     screenshots.add('', image2)
     return screenshots
@@ -53,7 +92,7 @@ def two_screenshots(image1, image2):
 
 @pytest.fixture
 def two_same_screenshots(image1):
-    screenshots = Screenshots(2)
+    screenshots = Screenshots(2, clock=count(step=common.TICK_INTERVAL).__next__)
     screenshots.add('', image1)
     screenshots.add('', image1)
     return screenshots
@@ -102,6 +141,86 @@ def test_create_references(references):
     assert not first_key.endswith('.png')
 
 
+@pytest.fixture
+def references_directory(tmp_path, image1, image2):
+    for key, image in [('common/ad', image1), ('ic/start', image2), ('mlp/next_episode', image1)]:
+        path = tmp_path / 'references' / ('%s.png' % key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        image.save(path)
+    return tmp_path / 'references'
+
+
+def test_references_are_scoped_and_lazy(references_directory, image2):
+    references = References(str(references_directory), ['ic'])
+    assert sorted(references) == ['common/ad', 'ic/start']
+    reference = references['ic/start']
+    assert isinstance(reference, LazyReference)
+    assert references['ic/start'] is reference
+    assert reference._image is None
+    assert reference.crop((0, 0, 10, 10)).tobytes() == image2.crop((0, 0, 10, 10)).tobytes()
+
+
+def test_reference_pack(references_directory, image2):
+    path = str(references_directory.parent / 'references.pack')
+    box = (10, 20, 30, 40)
+    references = References(str(references_directory), ['ic'])
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(references['ic/start'], 10, 20, 20, 20))])
+    assert update_reference_pack(path, plan)
+    assert not update_reference_pack(path, plan)
+    assert ReferencePack(path).get('ic/start', box).tobytes() == image2.crop(box).tobytes()
+    reference = References(str(references_directory), ['ic'], path)['ic/start']
+    assert reference.crop(box).tobytes() == image2.crop(box).tobytes()
+    assert reference._image is None
+    os.utime(references_directory / 'ic' / 'start.png', ns=(0, 0))
+    reference = References(str(references_directory), ['ic'], path)['ic/start']
+    reference.crop(box)
+    assert reference._image is not None
+    assert update_reference_pack(path, plan)
+
+
+@pytest.fixture
+def large_image1() -> Image:
+    return frombytes('RGB', (512, 512), os.urandom(512 * 512 * 3))
+
+
+@pytest.fixture
+def large_image2() -> Image:
+    return frombytes('RGB', (512, 512), os.urandom(512 * 512 * 3))
+
+
+def test_similar_screenshot_condition_pyramid(mocker, large_image1, large_image2):
+    condition = SimilarScreenshotCondition(large_image1, 3, 5, 300, 300)
+    assert condition.pyramid_factors == [16, 4]
+    assert condition.get_level_box(16) == (16, 16, 288, 304)
+    assert condition.get_level_box(4) == (4, 8, 300, 304)
+    assert SimilarScreenshotCondition(large_image1, 0, 0, 100, 100).pyramid_factors == []
+    assert SimilarScreenshotCondition(large_image1, 0, 0, 300, 300, max_delta=1).pyramid_factors == []
+    pyramid = FramePyramid(large_image1)
+    assert condition.matches(large_image1, pyramid)
+    assert pyramid.get_level(16).size == (32, 32)
+    mocker.patch.object(condition, 'matches_samples', return_value=True)
+    spy = mocker.spy(common.ImageChops, 'difference')
+    assert not condition.matches(large_image2, FramePyramid(large_image2))
+    assert spy.call_count == 0
+
+
+def test_reference_pack_with_pyramid_levels(tmp_path, large_image1):
+    path = tmp_path / 'references' / 'common' / 'power_off.png'
+    path.parent.mkdir(parents=True)
+    large_image1.save(path)
+    references = References(str(tmp_path / 'references'))
+    condition = SimilarScreenshotCondition(references['common/power_off'], 0, 0, 512, 512)
+    assert update_reference_pack(str(tmp_path / 'references.pack'), compile_stages([ConditionStage(condition)]))
+    pack = ReferencePack(str(tmp_path / 'references.pack'))
+    assert pack.get('common/power_off', (0, 0, 512, 512), 16).tobytes() == \
+        large_image1.reduce(4).reduce(4).tobytes()
+    references = References(str(tmp_path / 'references'), pack_path=str(tmp_path / 'references.pack'))
+    reference = references['common/power_off']
+    pyramid = FramePyramid(large_image1)
+    assert SimilarScreenshotCondition(reference, 0, 0, 512, 512).matches_levels(pyramid)
+    assert reference._image is None
+
+
 def test_true_condition(true_condition, single_screenshot, stages):
     result = true_condition.is_met(single_screenshot, stages)
     assert result
@@ -129,6 +248,45 @@ def test_similar_screenshot_condition(image1, image2, single_screenshot, stages)
     assert not result
 
 
+def add_noise(image: Image, pixels: List[Tuple[int, int]], delta: int) -> Image:
+    result = image.copy()
+    for x, y in pixels:
+        result.putpixel((x, y), tuple(min(value + delta, 255) if value < 128 else value - delta
+                                      for value in image.getpixel((x, y))))
+    return result
+
+
+def test_similar_screenshot_condition_with_tolerance(image1):
+    slightly_noisy = add_noise(image1, [(x, 50) for x in range(100)], 1)
+    assert not SimilarScreenshotCondition(image1, 0, 0, 100, 100).matches(slightly_noisy)
+    assert SimilarScreenshotCondition(image1, 0, 0, 100, 100, max_delta=1).matches(slightly_noisy)
+    noisy = add_noise(image1, [(x, 50) for x in range(5)], 100)
+    assert not SimilarScreenshotCondition(image1, 0, 0, 100, 100, max_delta=1).matches(noisy)
+    assert SimilarScreenshotCondition(image1, 0, 0, 100, 100, max_mismatch=0.001).matches(noisy)
+    assert not SimilarScreenshotCondition(image1, 0, 0, 100, 100, max_mismatch=0.0001).matches(noisy)
+
+
+def test_similar_screenshot_condition_rejects_on_samples(mocker, image1, image2):
+    spy = mocker.spy(common.ImageChops, 'difference')
+    condition = SimilarScreenshotCondition(image1, 0, 0, 100, 100)
+    assert len(condition.samples) == 16
+    assert not condition.matches(image2)
+    assert spy.call_count == 0
+    assert condition.matches(image1)
+    assert spy.call_count == 1
+
+
+def test_compile_stages_with_tolerance(image1):
+    noisy = add_noise(image1, [(x, 5) for x in range(10)], 2)
+    exact = ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10))
+    tolerant = ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10, max_delta=2))
+    plan = compile_stages([exact, tolerant, UnknownStage(None)])
+    assert not plan.is_exclusive(0, 1)
+    screenshots = Screenshots()
+    screenshots.add(None, noisy)
+    assert get_current_stage(plan, screenshots, Stages()) is tolerant
+
+
 def test_same_screenshot_condition(single_screenshot, two_same_screenshots, two_screenshots, stages):
     result = SameScreenshotCondition().is_met(single_screenshot, stages)
     assert not result
@@ -138,6 +296,19 @@ def test_same_screenshot_condition(single_screenshot, two_same_screenshots, two_
     assert not result
 
 
+def test_same_screenshot_condition_waits_for_tick_interval(image1, image2, stages):
+    now = [100.0]
+    screenshots = Screenshots(clock=lambda: now[0])
+    plan = compile_stages([ConditionStage(SameScreenshotCondition()), UnknownStage(None)])
+    results = []
+    for frame, elapsed in ((image1, 0), (image1, 0.3), (image1, 1), (image1, common.TICK_INTERVAL),
+                           (image2, common.TICK_INTERVAL + 1), (image2, common.TICK_INTERVAL * 2 + 1)):
+        now[0] = 100.0 + elapsed
+        screenshots.add(None, frame)
+        results.append(get_current_stage(plan, screenshots, stages))
+    assert results == [plan[1], plan[1], plan[1], plan[0], plan[1], plan[0]]
+
+
 def test_ic_get_stages_to_test(ic_stages_to_test):
     for stage in ic_stages_to_test:
         assert stage.get_command(Stages(1)) is not None
@@ -155,11 +326,72 @@ def test_screenshots(two_screenshots, image1, image2):
     assert two_screenshots.last == image2
 
 
+def test_screenshots_fingerprint(image1):
+    screenshots = Screenshots(2, regions=[(0, 0, 10, 10)])
+    screenshots.add(None, image1)
+    screenshots.add(None, image1.copy())
+    assert screenshots.last_fingerprint.digest == screenshots.previous_fingerprint.digest
+    assert list(screenshots.last_fingerprint.regions) == [(0, 0, 10, 10)]
+
+
+def test_screenshots_ring_buffer(image1, image2, tmp_path):
+    path = tmp_path / 'image.png'
+    path.write_bytes(b'')
+    screenshots = Screenshots(2, tail_count=2, tail_format='compressed')
+    screenshots.add(str(path), image1)
+    screenshots.add(None, image2)
+    screenshots.add(None, image2)
+    assert screenshots.last == image2
+    assert screenshots.previous == image2
+    assert not path.exists()
+    assert len(screenshots.tail) == 1
+    assert screenshots.restore(screenshots.tail[0]).tobytes() == image1.tobytes()
+    assert screenshots.memory_usage == 2 * 100 * 100 * 3 + len(screenshots.tail[0].data)
+
+
+def test_screenshots_tail_memory_budget(image1, image2):
+    screenshots = Screenshots(1, tail_count=10, tail_format='compressed', max_tail_bytes=1)
+    screenshots.add(None, image1)
+    screenshots.add(None, image2)
+    assert not screenshots.tail
+
+
+def test_screenshots_fingerprint_tail(image1, image2):
+    screenshots = Screenshots(1, tail_count=1)
+    screenshots.add(None, image1)
+    screenshots.add(None, image2)
+    assert screenshots.tail[0].data is None
+    assert screenshots.restore(screenshots.tail[0]) is None
+
+
 def test_stages(stages):
     assert isinstance(stages.previous, UnknownStage)
     assert not stages.is_unknown_for_long_time
 
 
+def test_stages_run_length():
+    now = [0.0]
+    stages = Stages(clock=lambda: now[0])
+    start, unknown = StartStage(None), UnknownStage(None)
+    for stage in [start, start, unknown, unknown, unknown]:
+        stages.add(stage)
+        now[0] += 30
+    assert stages.current is unknown
+    assert stages.previous is unknown
+    assert stages.previous_distinct is start
+    assert stages.current_run_length == 3
+    assert stages.get_run_length(UnknownStage) == 3
+    assert stages.get_run_length(StartStage) == 0
+    assert stages.time_in_current_stage == timedelta(seconds=90)
+    assert not stages.is_unknown_for_long_time
+    now[0] += 10
+    assert stages.is_unknown_for_long_time
+    histogram = stages.dwell_histograms['StartStage()']
+    assert histogram['count'] == 1
+    assert histogram['sum'] == 60
+    assert histogram['buckets']['60'] == 1
+
+
 @pytest.mark.skip(reason='device required')
 def test_grab_screenshot(tmp_path):
     path = str(tmp_path)
@@ -176,13 +408,853 @@ def test_grab_screenshot_if_cannot_grab(mocker, tmp_path):
     assert result is None
 
 
+def create_screencap(image: Image) -> bytes:
+    return struct.pack('<III', image.width, image.height, 1) + image.convert('RGBA').tobytes()
+
+
+def test_parse_screencap(image1):
+    result = parse_screencap(create_screencap(image1))
+    assert result.mode == 'RGB'
+    assert result.tobytes() == image1.tobytes()
+
+
+def test_parse_screencap_if_truncated(image1):
+    result = parse_screencap(create_screencap(image1)[:-1])
+    assert result is None
+
+
+def test_screencap_grabber(mocker, image1):
+    mocker.patch.object(common, 'run_process')
+    common.run_process.return_value.returncode = 0
+    common.run_process.return_value.stdout = create_screencap(image1)
+    result = ScreencapGrabber().grab()
+    assert result.tobytes() == image1.tobytes()
+
+
+def test_screencap_grabber_if_cannot_grab(mocker):
+    mocker.patch.object(common, 'run_process')
+    common.run_process.return_value.returncode = 1
+    result = ScreencapGrabber().grab()
+    assert result is None
+
+
+def test_get_required_rows(image1):
+    stages_to_test = [StartStage({'ic/start': image1, 'ic/start_bonus': image1}), UnknownStage(None)]
+    result = get_required_rows(stages_to_test)
+    assert result == [(929, 1013), (1363, 1475)]
+
+
+@pytest.fixture
+def fake_screencap(tmp_path, monkeypatch, image1):
+    (tmp_path / 'frame.raw').write_bytes(create_screencap(image1))
+    script = tmp_path / 'screencap'
+    script.write_text('#!/bin/sh\ncat %s\n' % (tmp_path / 'frame.raw'))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmp_path, os.environ['PATH']))
+    return tmp_path
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_region_grabber(fake_screencap, image1, compression):
+    grabber = RegionGrabber([(10, 20), (50, 60)], compression, width=100, height=100, args=['sh', '-c'],
+                            remote_path=str(fake_screencap / 'remote.raw'))
+    result = grabber.grab()
+    assert result.size == image1.size
+    assert result.crop((0, 10, 100, 20)).tobytes() == image1.crop((0, 10, 100, 20)).tobytes()
+    assert result.crop((0, 50, 100, 60)).tobytes() == image1.crop((0, 50, 100, 60)).tobytes()
+    assert not result.crop((0, 20, 100, 50)).getbbox()
+
+
+def test_region_grabber_windows(fake_screencap, image1):
+    grabber = RegionGrabber([], width=100, height=100, args=['sh', '-c'],
+                            remote_path=str(fake_screencap / 'remote.raw'),
+                            windows=[(10, 10, 30, 20), (0, 50, 100, 60)])
+    result = grabber.grab()
+    assert result.crop((10, 10, 30, 20)).tobytes() == image1.crop((10, 10, 30, 20)).tobytes()
+    assert result.crop((0, 50, 100, 60)).tobytes() == image1.crop((0, 50, 100, 60)).tobytes()
+    assert not result.crop((0, 0, 10, 50)).getbbox()
+    assert not result.crop((30, 10, 100, 20)).getbbox()
+
+
+def test_get_required_windows(image1):
+    stages_to_test = [ConditionStage(SimilarScreenshotCondition(image1, 10, 10, 20, 10)),
+                      ConditionStage(SimilarScreenshotCondition(image1, 40, 15, 10, 10)),
+                      ConditionStage(SimilarScreenshotCondition(image1, 60, 30, 10, 80)), UnknownStage(None)]
+    assert get_required_windows(stages_to_test, 100, max_window_rows=64) == [(10, 10, 50, 25), (0, 30, 100, 110)]
+
+
+def test_region_grabber_if_unexpected_size(fake_screencap):
+    grabber = RegionGrabber([(10, 20)], args=['sh', '-c'], remote_path=str(fake_screencap / 'remote.raw'))
+    result = grabber.grab()
+    assert result is None
+
+
+@pytest.fixture
+def fake_adb(tmp_path, monkeypatch, image1, image2):
+    frames = tmp_path / 'frames'
+    frames.mkdir()
+    image1.save(frames / '1.png')
+    image2.save(frames / '2.png')
+    monkeypatch.setenv('FAKE_ADB_FRAMES', str(frames))
+    monkeypatch.setenv('FAKE_ADB_STATE', str(tmp_path / 'fake_adb.index'))
+    monkeypatch.setenv('FAKE_ADB_LOG', str(tmp_path / 'fake_adb.log'))
+    monkeypatch.setattr(common, 'ADB', os.path.abspath('fake_adb'))
+    return tmp_path
+
+
+def read_fake_adb_log(fake_adb) -> List[List[str]]:
+    with open(fake_adb / 'fake_adb.log') as file:
+        return [json.loads(line)['args'] for line in file]
+
+
+def test_set_adb_path(monkeypatch):
+    monkeypatch.setattr(common, 'ADB', common.ADB)
+    monkeypatch.delenv('ADB', raising=False)
+    set_adb_path('/some/adb')
+    assert common.get_adb_args('serial') == ['/some/adb', '-s', 'serial']
+    assert os.environ['ADB'] == '/some/adb'
+
+
+def test_screencap_grabber_with_fake_adb(fake_adb, image1, image2):
+    grabber = ScreencapGrabber('serial')
+    assert grabber.grab().tobytes() == image1.tobytes()
+    assert grabber.grab().tobytes() == image2.tobytes()
+    assert grabber.grab().tobytes() == image1.tobytes()
+
+
+def test_screencap_grabber_with_failing_fake_adb(fake_adb, monkeypatch):
+    monkeypatch.setenv('FAKE_ADB_FAILURE_RATE', '1')
+    assert ScreencapGrabber().grab() is None
+
+
+def test_region_grabber_with_fake_adb(fake_adb, image1):
+    grabber = RegionGrabber([(10, 20)], 'gzip', width=100, height=100,
+                            remote_path=str(fake_adb / 'remote.raw'))
+    result = grabber.grab()
+    assert result.crop((0, 10, 100, 20)).tobytes() == image1.crop((0, 10, 100, 20)).tobytes()
+
+
+def test_adb_shell_with_fake_adb(fake_adb):
+    shell = AdbShell.for_device('serial')
+    try:
+        command = BatchCommand(StartGameCommand('package', '.Activity'), ClickCommand(1, 2), TogglePowerCommand())
+        command.execute(shell)
+    finally:
+        shell.close()
+    assert read_fake_adb_log(fake_adb) == [['am', 'start', '-n', 'package/.Activity'], ['input', 'tap', '1', '2'],
+                                           ['input', 'keyevent', '26']]
+
+
+@pytest.fixture
+def shell():
+    shell = AdbShell(['sh'])
+    yield shell
+    shell.close()
+
+
+def test_adb_shell(shell):
+    assert shell.run('true') == 0
+    process = shell._process
+    assert shell.run('echo', 'some output') == 0
+    assert shell.run('false') == 1
+    assert shell._process is process
+
+
+def test_adb_shell_if_session_closed(shell):
+    assert shell.run('exit') == AdbShell.FAILED_STATUS
+    assert shell.run('true') == 0
+
+
+def test_commands_use_shell():
+    shell = RecordingShell()
+    BatchCommand(ClickCommand(1, 2), TogglePowerCommand()).execute(shell)
+    assert shell.calls == [('input', 'tap', 1, 2), ('input', 'keyevent', 26)]
+
+
+def test_adb_shell_check_output(shell):
+    assert shell.check_output('echo', 'some output') == 'some output\n'
+    assert shell.check_output('printf', 'no newline') == 'no newline'
+    assert shell.check_output('false') is None
+
+
+GETEVENT_OUTPUT = '''add device 1: /dev/input/event4
+  name:     "gpio-keys"
+  events:
+    KEY (0001): KEY_VOLUMEDOWN        KEY_VOLUMEUP          KEY_POWER
+add device 2: /dev/input/event2
+  name:     "sec_touchscreen"
+  events:
+    KEY (0001): BTN_TOUCH
+    ABS (0003): ABS_MT_SLOT           : value 0, min 0, max 9, fuzz 0, flat 0, resolution 0
+                ABS_MT_POSITION_X     : value 0, min 0, max 4095, fuzz 0, flat 0, resolution 0
+                ABS_MT_POSITION_Y     : value 0, min 0, max 4095, fuzz 0, flat 0, resolution 0
+                ABS_MT_TRACKING_ID    : value 0, min 0, max 65535, fuzz 0, flat 0, resolution 0
+'''
+
+
+def test_parse_touchscreen():
+    assert parse_touchscreen(GETEVENT_OUTPUT) == TouchScreen('/dev/input/event2', (0, 4095), (0, 4095), True, True,
+                                                             True)
+    assert parse_touchscreen(GETEVENT_OUTPUT.split('add device 2')[0]) is None
+
+
+def test_sendevent_tapper_events():
+    touchscreen = parse_touchscreen(GETEVENT_OUTPUT)
+    tapper = SendeventTapper(touchscreen, (2560, 1600))
+    assert tapper.to_touch(0, 0) == (0, 0)
+    assert tapper.to_touch(1280, 800) == (2048, 2048)
+    assert tapper.to_touch(2559, 1599) == (4094, 4093)
+    assert SendeventTapper(touchscreen, (2560, 1600), rotation=1).to_touch(0, 0) == (4094, 0)
+    events = [struct.unpack('<qqHHi', chunk) for chunk in iter_chunks(tapper.get_events(1280, 800), 24)]
+    assert [event[2:] for event in events] == [(3, 0x2f, 0), (3, 0x39, 1), (3, 0x35, 2048), (3, 0x36, 2048),
+                                               (1, 0x14a, 1), (0, 0, 0), (3, 0x39, -1), (1, 0x14a, 0), (0, 0, 0)]
+    assert len(SendeventTapper(touchscreen, (2560, 1600), word_size=32).get_events(1, 2)) == 9 * 16
+    assert tapper.get_stream(1280, 800).startswith('\\000')
+
+
+def iter_chunks(data: bytes, size: int) -> List[bytes]:
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+
+def test_sendevent_tap_with_fake_adb(fake_adb, monkeypatch, mocker):
+    monkeypatch.setenv('FAKE_ADB_TOUCHSCREEN', str(fake_adb / 'event2'))
+    shell = AdbShell.for_device('serial')
+    try:
+        shell.tapper = SendeventTapper.discover(shell)
+        assert shell.tapper is not None
+        spy = mocker.spy(shell, 'run_line')
+        ClickCommand(1280, 800).execute(shell)
+        ClickCommand(10, 20).execute(shell)
+        assert spy.call_args_list[-1].args[0] == "printf '%s' > %s" % (shell.tapper.get_stream(10, 20),
+                                                                       fake_adb / 'event2')
+    finally:
+        shell.close()
+    assert (fake_adb / 'event2').read_bytes() == shell.tapper.get_events(10, 20)
+    assert ['input', 'tap', '1280', '800'] not in read_fake_adb_log(fake_adb)
+
+
+def test_sendevent_tap_falls_back_to_input_tap(fake_adb, monkeypatch):
+    monkeypatch.setenv('FAKE_ADB_TOUCHSCREEN', str(fake_adb / 'missing' / 'event2'))
+    shell = AdbShell.for_device('serial')
+    try:
+        shell.tapper = SendeventTapper.discover(shell)
+        ClickCommand(1, 2).execute(shell)
+        assert shell.tapper is None
+    finally:
+        shell.close()
+    assert read_fake_adb_log(fake_adb)[-1] == ['input', 'tap', '1', '2']
+
+
+def test_sendevent_tapper_without_touchscreen(fake_adb):
+    shell = AdbShell.for_device('serial')
+    try:
+        assert SendeventTapper.discover(shell) is None
+    finally:
+        shell.close()
+
+
+def wait_for_changes(monitor: ScreenRecordMonitor, changes: Optional[int], timeout: float = 10):
+    deadline = time() + timeout
+    while monitor.changes == changes and time() < deadline:
+        sleep(0.01)
+    assert monitor.changes != changes
+
+
+@pytest.fixture
+def screen_stream(fake_adb, monkeypatch):
+    path = fake_adb / 'stream.fifo'
+    os.mkfifo(path)
+    monkeypatch.setenv('FAKE_ADB_STREAM', str(path))
+    descriptor = os.open(path, os.O_RDWR)
+    yield descriptor
+    os.close(descriptor)
+
+
+def test_stream_grabber_reuses_capture_until_screen_changes(fake_adb, screen_stream, image1, image2):
+    monitor = ScreenRecordMonitor(64, 40, restart=False)
+    grabber = StreamGrabber(ScreencapGrabber(), monitor)
+    try:
+        os.write(screen_stream, b'frame')
+        wait_for_changes(monitor, None)
+        first = grabber.grab()
+        assert first.tobytes() == image1.tobytes()
+        second = grabber.grab()
+        assert second is not first
+        assert second.tobytes() == image1.tobytes()
+        assert grabber.timings == {'capture': 0.0, 'decode': 0.0}
+        changes = monitor.changes
+        os.write(screen_stream, b'frame')
+        wait_for_changes(monitor, changes)
+        assert grabber.grab().tobytes() == image2.tobytes()
+    finally:
+        grabber.close()
+    log = read_fake_adb_log(fake_adb)
+    assert log[0] == ['screenrecord', '--output-format=h264', '--size', '64x40', '--bit-rate', '1000000', '-']
+    assert log[1:] == [['screencap'], ['screencap']]
+
+
+def test_stream_grabber_captures_after_max_age(fake_adb, screen_stream, image1, image2):
+    monitor = ScreenRecordMonitor(restart=False)
+    grabber = StreamGrabber(ScreencapGrabber(), monitor, max_age=0)
+    try:
+        os.write(screen_stream, b'frame')
+        wait_for_changes(monitor, None)
+        assert grabber.grab().tobytes() == image1.tobytes()
+        assert grabber.grab().tobytes() == image2.tobytes()
+    finally:
+        grabber.close()
+
+
+def test_stream_grabber_without_stream(fake_adb, image1, image2):
+    grabber = StreamGrabber(ScreencapGrabber(), ScreenRecordMonitor(restart=False))
+    try:
+        assert grabber.grab().tobytes() == image1.tobytes()
+        assert grabber.grab().tobytes() == image2.tobytes()
+    finally:
+        grabber.close()
+
+
+def test_tick_scheduler():
+    scheduler = TickScheduler()
+    stage = UnknownStage(None)
+    assert scheduler.get_interval(stage, ClickCommand(1, 2), True) == TickScheduler.FAST_INTERVAL
+    assert scheduler.get_interval(stage, NoOpCommand(), False) == TickScheduler.FAST_INTERVAL
+    assert scheduler.get_interval(stage, NoOpCommand(), True) == stage.MIN_INTERVAL
+    assert scheduler.get_interval(stage, NoOpCommand(), False) == stage.MIN_INTERVAL * 2
+    assert scheduler.get_interval(stage, NoOpCommand(), False) == stage.MIN_INTERVAL * 4
+    for _ in range(10):
+        result = scheduler.get_interval(stage, NoOpCommand(), False)
+    assert result == stage.MAX_INTERVAL
+    assert scheduler.get_interval(stage, NoOpCommand(), True) == stage.MIN_INTERVAL
+
+
+def test_tick_scheduler_stops_fast_polling():
+    scheduler = TickScheduler()
+    stage = UnknownStage(None)
+    scheduler.get_interval(stage, BatchCommand(TogglePowerCommand(), ClickCommand(1, 2)), True)
+    for _ in range(TickScheduler.MAX_FAST_POLLS):
+        assert scheduler.get_interval(stage, NoOpCommand(), False) == TickScheduler.FAST_INTERVAL
+    assert scheduler.get_interval(stage, NoOpCommand(), False) == stage.MIN_INTERVAL
+
+
+def test_tick_scheduler_does_not_fast_poll_stuck_ads():
+    scheduler = TickScheduler()
+    command = StartGameCommand('package', '.Main')
+    scheduler.get_interval(UnknownStage(None), ClickCommand(1, 2), True)
+    for stage in (common.UnknownAdStage(None, command), common.UnityAdStage(None, command),
+                  mlp.AnotherAdStage(None)):
+        assert scheduler.get_interval(stage, stage.get_command(Stages()), False) == common.TICK_INTERVAL
+
+
+def test_deadlines(tmp_path):
+    now = [1000.0]
+    path = str(tmp_path / 'deadlines.json')
+    deadlines = Deadlines(path, clock=lambda: now[0])
+    deadlines.schedule('first', timedelta(minutes=10), [ClickCommand(1, 2)])
+    deadlines.schedule('second', timedelta(minutes=5))
+    assert deadlines.get_next() == (1300.0, 'second')
+    assert deadlines.get_remaining('first') == 600
+    assert Deadlines(path, clock=lambda: now[0]).get_remaining('first') == 600
+    now[0] += 600
+    assert deadlines.get_remaining('first') == 0
+    assert len(deadlines.pop('first')) == 1
+    assert deadlines.pop('first') == []
+    assert deadlines.get_next() == (1300.0, 'second')
+    assert Deadlines(path, clock=lambda: now[0]).get_next() == (1300.0, 'second')
+
+
+def test_execute_command_with_deadlines(mocker):
+    shell = mocker.Mock()
+    deadlines = Deadlines()
+    command = BatchCommand(TogglePowerCommand(), WaitCommand(timedelta(minutes=30)), ClickCommand(1, 2))
+    execute_command(command, shell, deadlines, 'device')
+    shell.run.assert_called_once_with('input', 'keyevent', 26)
+    assert deadlines.get_remaining('device') > 0
+    remaining = deadlines.pop('device')
+    assert len(remaining) == 1 and isinstance(remaining[0], ClickCommand)
+
+
+def test_async_adb_shell():
+    async def run():
+        shell = AsyncAdbShell(['sh'])
+        try:
+            return [await shell.run('true'), await shell.run('false'), await shell.run('exit'),
+                    await shell.run('true')]
+        finally:
+            await shell.close()
+    assert asyncio.run(run()) == [0, 1, AdbShell.FAILED_STATUS, 0]
+
+
+def test_execute_command_async(mocker):
+    shell = mocker.AsyncMock()
+    mocker.patch.object(devices.asyncio, 'sleep')
+    command = BatchCommand(StartGameCommand('package', '.Activity'), WaitCommand(timedelta(minutes=10)),
+                           ClickCommand(1, 2))
+    asyncio.run(devices.execute_command(command, shell))
+    assert shell.run.call_args_list == [mocker.call('am', 'start', '-n', 'package/.Activity'),
+                                        mocker.call('input', 'tap', 1, 2)]
+    devices.asyncio.sleep.assert_called_once_with(600)
+
+
+def test_device_runner_handle_tick(mocker, image1):
+    grabber = mocker.Mock()
+    grabber.grab = mocker.AsyncMock(return_value=image1)
+    shell = mocker.AsyncMock()
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10), ClickCommand(1, 2)),
+                           UnknownStage(None)])
+    runner = DeviceRunner('serial', plan, grabber, shell)
+    result = asyncio.run(runner.handle_tick())
+    assert result == TickScheduler.FAST_INTERVAL
+    shell.run.assert_called_once_with('input', 'tap', 1, 2)
+
+
+def create_batch_references():
+    return {'frame': frombytes('RGB', (100, 100), bytes(range(256)) * 117 + bytes(48))}
+
+
+def create_batch_stages(references):
+    return compile_stages([
+        ConditionStage(SimilarScreenshotCondition(references['frame'], 0, 0, 100, 100)),
+        UnknownStage(references)
+    ])
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_classify_frames(tmp_path, image1, workers):
+    directory = tmp_path / 'frames'
+    directory.mkdir()
+    create_batch_references()['frame'].save(directory / 'a.png')
+    (directory / 'b.raw').write_bytes(create_screencap(image1))
+    (directory / 'c.txt').write_text('')
+    output = StringIO()
+    result = classify_frames(str(directory), create_batch_stages, create_batch_references, workers, 1, output)
+    assert result == 2
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line['frame'] for line in lines] == [str(directory / 'a.png'), str(directory / 'b.raw')]
+    assert [line['stage'] for line in lines] == ['ConditionStage()', 'UnknownStage()']
+    assert all(line['time'] >= 0 for line in lines)
+
+
+def test_classify_frames_from_tar(tmp_path, image1):
+    image1.save(tmp_path / 'a.png')
+    with tarfile.open(tmp_path / 'frames.tar', 'w') as archive:
+        archive.add(tmp_path / 'a.png', 'frames/a.png')
+    output = StringIO()
+    result = classify_frames(str(tmp_path / 'frames.tar'), create_batch_stages, create_batch_references, 0,
+                             output=output)
+    assert result == 1
+    assert json.loads(output.getvalue())['frame'] == 'frames/a.png'
+
+
+class ListGrabber(Grabber):
+
+    def __init__(self, screenshots: List[Image]):
+        self._screenshots = list(screenshots)
+
+    def grab(self) -> Optional[Image]:
+        return self._screenshots.pop(0) if self._screenshots else None
+
+
+def test_record_and_replay_session(tmp_path, mocker, image1, image2):
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10), ClickCommand(1, 2)),
+                           UnknownStage(None)])
+    now = [100.0]
+    recorder = SessionRecorder(str(tmp_path / 'session'), lambda: now[0])
+    grabber = ListGrabber([image1, image2, image1.copy()])
+    screenshots, stages = Screenshots(), Stages()
+    for _ in range(3):
+        screenshots, stages, _ = handle_tick(plan, grabber, screenshots, stages, mocker.Mock(), recorder=recorder)
+        now[0] += 5
+    recorder.close()
+    assert len(os.listdir(tmp_path / 'session' / 'frames')) == 2
+    results = replay_session(str(tmp_path / 'session'), plan)
+    assert [result['time'] for result in results] == [100, 105, 110]
+    assert [result['actual'] for result in results] == ['ConditionStage()', 'UnknownStage()', 'ConditionStage()']
+    assert all(result['actual'] == result['expected'] for result in results)
+    assert results[0]['actual_commands'] == ['ClickCommand(1, 2)']
+
+
+def test_handle_tick_metrics(tmp_path, mocker, image1, image2):
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10), ClickCommand(1, 2)),
+                           UnknownStage(None)])
+    ticks = []
+    metrics = TickMetrics([ticks.append, MetricsFile(str(tmp_path / 'metrics.jsonl'))])
+    grabber = ListGrabber([image1, image2])
+    screenshots, stages = Screenshots(), Stages()
+    for _ in range(3):
+        screenshots, stages, _ = handle_tick(plan, grabber, screenshots, stages, mocker.Mock(), metrics=metrics)
+    snapshot = metrics.snapshot()
+    assert snapshot['ticks'] == 3
+    assert snapshot['capture_failures'] == 1
+    assert snapshot['stages'] == {'ConditionStage': 1, 'UnknownStage': 1}
+    assert snapshot['commands'] == {'ClickCommand': 1, 'NoOpCommand': 1}
+    assert snapshot['histograms']['classify']['count'] == 2
+    assert snapshot['histograms']['sleep']['count'] == 3
+    assert [tick['stage'] for tick in ticks] == ['ConditionStage', 'UnknownStage', None]
+    assert [tick['captured'] for tick in ticks] == [True, True, False]
+    assert set(ticks[0]['phases']) == set(TickMetrics.PHASES)
+    assert [json.loads(line) for line in (tmp_path / 'metrics.jsonl').read_text().splitlines()] == ticks
+
+
+def test_serve_metrics():
+    metrics = TickMetrics()
+    metrics.start_tick()
+    metrics.observe('capture', 0.2)
+    metrics.count_stage(UnknownStage(None))
+    metrics.count_capture_failure()
+    metrics.finish_tick()
+    text = format_prometheus(metrics)
+    assert 'bot_ticks_total 1\n' in text
+    assert 'bot_capture_failures_total 1\n' in text
+    assert 'bot_stage_ticks_total{stage="UnknownStage"} 1\n' in text
+    assert 'bot_phase_seconds_bucket{phase="capture",le="0.1"} 0\n' in text
+    assert 'bot_phase_seconds_bucket{phase="capture",le="+Inf"} 1\n' in text
+    server = serve_metrics(metrics, 0)
+    try:
+        with urlopen('http://127.0.0.1:%s/metrics' % server.server_address[1]) as response:
+            assert response.read().decode() == text
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_condition_profiler(image1, image2):
+    first = SimilarScreenshotCondition(image1, 0, 0, 10, 10)
+    second = SimilarScreenshotCondition(image2, 0, 0, 10, 10)
+    stages_to_test = [ConditionStage(AndCondition(first, NotCondition(second))), ConditionStage(second),
+                      UnknownStage(None)]
+    profiler = ConditionProfiler(compile_stages(stages_to_test))
+    for image in (image1, image2, image2):
+        screenshots = Screenshots()
+        screenshots.add(None, image)
+        assert get_current_stage(profiler, screenshots, Stages()) is stages_to_test[0 if image is image1 else 1]
+    counters = dict(zip(profiler, profiler._stage_counters))
+    assert (counters[stages_to_test[0]].evaluations, counters[stages_to_test[0]].hits) == (3, 1)
+    assert (counters[stages_to_test[1]].evaluations, counters[stages_to_test[1]].hits) == (2, 2)
+    assert counters[stages_to_test[2]].evaluations == 0
+    assert profiler._condition_counters[str(first)].evaluations == 3
+    assert profiler._condition_counters[str(second)].evaluations == 3
+    report = profiler.get_report()
+    assert report.startswith('Profiled 3 frames')
+    assert str(first) in report and 'ConditionStage()' in report
+
+
+def classify_sequence(plan: StagePlan, images: List[Image]) -> List[Stage]:
+    stages = Stages()
+    result = []
+    for image in images:
+        screenshots = Screenshots()
+        screenshots.add(None, image)
+        stage = plan.get_current_stage(screenshots, stages)
+        stages.add(stage)
+        result.append(stage)
+    return result
+
+
+def test_stage_plan_tries_likely_successors_first(mocker, image1, image2):
+    stages_to_test = [ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10)),
+                      ConditionStage(SimilarScreenshotCondition(image2, 0, 0, 10, 10)),
+                      UnknownStage(None)]
+    plan = compile_stages(stages_to_test)
+    assert plan.is_exclusive(0, 1)
+    assert not plan.is_exclusive(0, 2)
+    assert classify_sequence(plan, [image1, image2, image1.copy(), image2.copy()]) == [
+        stages_to_test[0], stages_to_test[1], stages_to_test[0], stages_to_test[1]]
+    assert plan.transitions == {None: {0: 1}, 0: {1: 2}, 1: {0: 1}}
+    screenshot = image2.copy()
+    screenshot.paste(image1.crop((50, 50, 60, 60)), (50, 50))
+    screenshots = Screenshots()
+    screenshots.add(None, screenshot)
+    stages = Stages()
+    stages.add(stages_to_test[0])
+    plan._region_cache.clear()
+    spy = mocker.spy(plan._matcher, '_is_met')
+    assert plan.get_current_stage(screenshots, stages) is stages_to_test[1]
+    assert [call.args[0] for call in spy.call_args_list] == [1]
+
+
+def test_stage_plan_keeps_first_match_with_transitions(image1, image2):
+    stages_to_test = [ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10)),
+                      ConditionStage(SimilarScreenshotCondition(image1, 20, 20, 10, 10)),
+                      ConditionStage(SimilarScreenshotCondition(image2, 0, 0, 10, 10)),
+                      UnknownStage(None)]
+    plan = compile_stages(stages_to_test)
+    plan.add_transition(2, 1)
+    plan.add_transition(2, 1)
+    assert not plan.is_exclusive(0, 1)
+    assert classify_sequence(plan, [image2, image1]) == [stages_to_test[2], stages_to_test[0]]
+
+
+def test_learn_transitions(tmp_path, mocker, image1, image2):
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10)), UnknownStage(None)])
+    recorder = SessionRecorder(str(tmp_path / 'session'))
+    screenshots, stages = Screenshots(), Stages()
+    for image in (image1, image2, image1.copy()):
+        screenshots, stages, _ = handle_tick(plan, ListGrabber([image]), screenshots, stages, mocker.Mock(),
+                                             recorder=recorder)
+    recorder.close()
+    learned = compile_stages(list(plan))
+    assert learn_transitions(learned, str(tmp_path / 'session')) == 3
+    assert learned.transitions == {None: {0: 1}, 0: {1: 1}, 1: {0: 1}}
+
+
+class SlowShell(RecordingShell):
+
+    def run(self, *args: str) -> int:
+        sleep(0.05)
+        return super().run(*args)
+
+
+class SlowGrabber(Grabber):
+
+    def __init__(self, image: Image, shell: RecordingShell):
+        self._image = image
+        self._shell = shell
+        self.frames: List[Tuple[Image, float, int]] = []
+
+    def grab(self) -> Optional[Image]:
+        started, calls = time(), len(self._shell.calls)
+        sleep(0.1)
+        screenshot = self._image.copy()
+        self.frames.append((screenshot, started, calls))
+        return screenshot
+
+    def get_frame(self, screenshot: Image) -> Tuple[float, int]:
+        return next((started, calls) for frame, started, calls in self.frames if frame is screenshot)
+
+
+class SlowCondition(TrueCondition):
+
+    def __init__(self):
+        self.finished: List[float] = []
+
+    def is_met(self, screenshots: Screenshots, stages: Stages) -> bool:
+        sleep(0.1)
+        self.finished.append(time())
+        return True
+
+
+class ImmediateScheduler(TickScheduler):
+
+    def get_interval(self, stage: Stage, command: Command, changed: bool) -> float:
+        return 0
+
+
+def test_pipelined_runner_discards_stale_frames(image1):
+    shell = SlowShell()
+    grabber = SlowGrabber(image1, shell)
+    metrics = TickMetrics()
+    runner = PipelinedRunner([ConditionStage(SlowCondition(), ClickCommand(1, 2))], grabber, shell,
+                             metrics=metrics, scheduler=ImmediateScheduler())
+    try:
+        for tick in range(4):
+            runner.tick()
+            assert grabber.get_frame(runner.screenshots.last)[1] == tick
+    finally:
+        runner.close()
+    assert runner.pipeline.discarded >= 1
+    snapshot = metrics.snapshot()
+    assert snapshot['ticks'] == 4
+    assert snapshot['histograms']['execute']['count'] == 3
+
+
+def test_pipelined_runner_overlaps_capture_and_classification(image1):
+    shell = RecordingShell()
+    grabber = SlowGrabber(image1, shell)
+    condition = SlowCondition()
+    runner = PipelinedRunner([ConditionStage(condition)], grabber, shell, scheduler=ImmediateScheduler())
+    try:
+        for _ in range(3):
+            runner.tick()
+    finally:
+        runner.close()
+    assert grabber.get_frame(runner.screenshots.last)[0] < condition.finished[1]
+    assert runner.pipeline.discarded == 0
+    assert shell.calls == []
+
+
+def test_pipelined_runner_resumes_deadlines(image1):
+    shell = RecordingShell()
+    command = BatchCommand(ClickCommand(1, 2), WaitCommand(timedelta(seconds=0.1)), ClickCommand(3, 4))
+    runner = PipelinedRunner([ConditionStage(TrueCondition(), command)], SlowGrabber(image1, shell), shell,
+                             Deadlines(), scheduler=ImmediateScheduler())
+    try:
+        runner.tick()
+        runner.tick()
+    finally:
+        runner.close()
+    assert shell.calls[:2] == [('input', 'tap', 1, 2), ('input', 'tap', 3, 4)]
+
+
+class FailingGrabber(SlowGrabber):
+
+    def __init__(self, image: Image, shell: RecordingShell, failures: int):
+        super().__init__(image, shell)
+        self.failures = failures
+
+    def grab(self) -> Optional[Image]:
+        if self.failures:
+            self.failures -= 1
+            raise FileNotFoundError('adb')
+        return super().grab()
+
+
+def test_pipelined_runner_counts_capture_errors(image1):
+    shell = RecordingShell()
+    metrics = TickMetrics()
+    runner = PipelinedRunner([ConditionStage(TrueCondition())], FailingGrabber(image1, shell, 1), shell,
+                             metrics=metrics, scheduler=ImmediateScheduler())
+    try:
+        assert runner.tick() is None
+        assert runner.tick() is not None
+    finally:
+        runner.close()
+    assert metrics.snapshot()['capture_failures'] == 1
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_pipeline_get_frame_if_capture_thread_stopped(image1, mocker):
+    shell = RecordingShell()
+    mocker.patch('lib.pipeline.Frame', side_effect=RuntimeError('broken'))
+    runner = PipelinedRunner([ConditionStage(TrueCondition())], SlowGrabber(image1, shell), shell,
+                             scheduler=ImmediateScheduler())
+    try:
+        with pytest.raises(RuntimeError, match='capture thread has stopped'):
+            runner.tick()
+    finally:
+        runner.close()
+
+
+def test_runners_fingerprint_plan_regions(image1):
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10)), UnknownStage(None)])
+    assert get_fingerprint_regions(plan) == [(0, 0, 10, 10)]
+    assert get_fingerprint_regions(list(plan)) == []
+    shell = RecordingShell()
+    runner = PipelinedRunner(plan, SlowGrabber(image1, shell), shell, scheduler=ImmediateScheduler())
+    try:
+        assert runner.tick() is plan[0]
+    finally:
+        runner.close()
+    assert set(runner.screenshots.last_fingerprint.regions) == {(0, 0, 10, 10)}
+    assert list(plan._region_cache.values()) == [True]
+
+
 def test_get_current_stage_if_not_met(ic_stages_to_test, two_screenshots, stages):
     result = get_current_stage(ic_stages_to_test, two_screenshots, stages)
     assert isinstance(result, UnknownStage)
 
 
+@pytest.fixture(scope='module')
+def random_references():
+    reference = frombytes('RGB', (2560, 1600), os.urandom(2560 * 1600 * 3))
+    return defaultdict(lambda: reference)
+
+
+def test_compile_stages(random_references):
+    references = random_references
+    plan = compile_stages([StartBonusStage(references), StartStage(references), BankStage(references),
+                           BankTimerStage(references), UnknownStage(references)])
+    assert isinstance(plan, StagePlan)
+    assert len(plan) == 5
+    assert len(plan.conditions) == 5
+    assert len(plan._shared_conditions) == 4
+
+
+def test_compile_stages_memoizes_checks(mocker, random_references, single_screenshot, stages):
+    references = random_references
+    plan = compile_stages([StartBonusStage(references), StartStage(references), UnknownStage(references)])
+    spy = mocker.spy(SimilarScreenshotCondition, 'matches')
+    result = get_current_stage(plan, single_screenshot, stages)
+    assert isinstance(result, UnknownStage)
+    assert spy.call_count == 2
+    get_current_stage(plan, single_screenshot, stages)
+    assert spy.call_count == 2
+
+
+def test_compile_stages_with_region_conditions(image1, image2, single_screenshot, stages):
+    first = ConditionStage(AndCondition(SimilarScreenshotCondition(image1, 0, 0, 10, 10),
+                                SimilarScreenshotCondition(image2, 0, 0, 10, 10)))
+    second = ConditionStage(NotCondition(SimilarScreenshotCondition(image2, 0, 0, 10, 10)))
+    plan = compile_stages([first, second, UnknownStage(None)])
+    result = get_current_stage(plan, single_screenshot, stages)
+    assert result is second
+
+
+@pytest.fixture
+def colored_stages():
+    colors = [(index * 30, 0, 255 - index * 30) for index in range(8)]
+    stages_to_test = [ConditionStage(SimilarScreenshotCondition(new_image('RGB', (100, 100), color), 0, 0, 10, 10))
+                      for color in colors]
+    stages_to_test.insert(4, ConditionStage(NotCondition(stages_to_test[0].get_condition())))
+    stages_to_test.append(UnknownStage(None))
+    return colors, stages_to_test
+
+
+def test_pixel_index(colored_stages):
+    colors, stages_to_test = colored_stages
+    index = PixelIndex([stage.get_condition().get_requirements() for stage in stages_to_test])
+    result = index.get_candidates(new_image('RGB', (100, 100), colors[5]))
+    assert result == [4, 6, 9]
+
+
+def test_get_current_stage_with_pixel_index(colored_stages, stages):
+    colors, stages_to_test = colored_stages
+    plan = compile_stages(stages_to_test)
+    for color in colors + [(1, 2, 3)]:
+        screenshots = Screenshots(1)
+        screenshots.add(None, new_image('RGB', (100, 100), color))
+        result = get_current_stage(plan, screenshots, stages)
+        assert result is get_current_stage(stages_to_test, screenshots, stages)
+
+
+def test_get_current_stage_caches_identical_frames(mocker, image1, stages):
+    plan = compile_stages([ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 10, 10)), UnknownStage(None)])
+    spy = mocker.spy(SimilarScreenshotCondition, 'matches')
+    for _ in range(2):
+        screenshots = Screenshots(1)
+        screenshots.add(None, image1.copy())
+        result = get_current_stage(plan, screenshots, stages)
+        assert result is plan[0]
+    assert spy.call_count == 1
+
+
+def test_get_current_stage_does_not_cache_stateful_stages(two_screenshots, image2, stages):
+    plan = compile_stages([ConditionStage(SameScreenshotCondition()), UnknownStage(None)])
+    result = get_current_stage(plan, two_screenshots, stages)
+    assert result is plan[1]
+    two_screenshots.add(None, image2.copy())
+    result = get_current_stage(plan, two_screenshots, stages)
+    assert result is plan[0]
+
+
+def test_get_current_stage_with_same_screenshot_object(image1, image2, stages):
+    plan = compile_stages([ConditionStage(SameScreenshotCondition()),
+                           ConditionStage(SimilarScreenshotCondition(image1, 0, 0, 50, 50)), UnknownStage(None)])
+    screenshot = image1.copy()
+    screenshots = Screenshots(clock=count(step=common.TICK_INTERVAL).__next__)
+    results = []
+    for frame in (image2, screenshot, screenshot):
+        screenshots.add(None, frame)
+        results.append(get_current_stage(plan, screenshots, stages))
+    screenshot.paste(image2.crop((0, 0, 10, 10)), (20, 20))
+    screenshots.add(None, screenshot)
+    results.append(get_current_stage(plan, screenshots, stages))
+    assert results == [plan[2], plan[1], plan[0], plan[2]]
+
+
 def test_get_current_stage_if_met(mocker, two_screenshots, stages):
     stage = mocker.Mock()
     stage.get_condition().is_met.return_value = True
     result = get_current_stage([stage], two_screenshots, stages)
     assert result == stage
+
+
+def test_run_benchmarks():
+    report = bench.run_benchmarks(['mlp'], repeat=2, memory_frames=3)
+    results = report['results']
+    assert {'create_references', 'decode_raw', 'similar_full_not_met', 'same_met', 'get_current_stage_mlp',
+            'get_current_stage_mlp_legacy'} <= set(results)
+    assert results['get_current_stage_mlp']['repeat'] == 2
+    assert len(results['screenshots_memory_tail_compressed']['bytes']) == 3
+    assert json.loads(json.dumps(report)) == report
+    assert len(bench.compare(report, report)) == len(results)